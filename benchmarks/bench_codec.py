@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""Compare the JSON codec against the stdlib on specs and responses.
+
+Usage: python benchmarks/bench_codec.py [service] [rows]
+
+Decodes/encodes the synced spec of the service (cvadrestapis by default) and a
+response with the given number of rows, built from tests/data. A tenth of the
+rows is also dumped as YAML.
+"""
+
+import json
+import os
+import sys
+import time
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.jsoncodec as jsoncodec
+import cxcli.syncspecs as syncspecs
+import cxcli.yamlcodec as yamlcodec
+
+
+def timeit(function, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        function()
+    return (time.perf_counter() - start) / repetitions * 1000
+
+
+def compare(name, data, repetitions):
+    obj = json.loads(data)
+    results = {
+        "decode stdlib": timeit(lambda: json.loads(data), repetitions),
+        "decode codec": timeit(lambda: jsoncodec.loads(data), repetitions),
+        "encode stdlib": timeit(lambda: json.dumps(obj, indent=2), repetitions),
+        "encode codec": timeit(lambda: jsoncodec.dumpb(obj, indent=True), repetitions),
+    }
+    print(f"{name} ({len(data) / 1024 / 1024:.1f} MiB)")
+    for label, milliseconds in results.items():
+        print(f"  {label}: {milliseconds:.2f} ms")
+
+
+def compare_yaml(name, obj, repetitions):
+    results = {
+        "dump pure": timeit(
+            lambda: yaml.dump(obj, Dumper=yaml.SafeDumper, sort_keys=False),
+            repetitions,
+        ),
+        "dump codec": timeit(lambda: yamlcodec.dump(obj), repetitions),
+    }
+    print(f"{name} as YAML")
+    for label, milliseconds in results.items():
+        print(f"  {label}: {milliseconds:.2f} ms")
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else "cvadrestapis"
+    rows = int(sys.argv[2]) if len(sys.argv) > 2 else 50000
+    print(f"Native codec: {'orjson' if jsoncodec.orjson else 'unavailable'}")
+    specpath = os.path.join(syncspecs.APISPECPATH, f"{name}.json")
+    if os.path.exists(specpath):
+        with open(specpath, "rb") as fp:
+            compare(f"{name} spec", fp.read(), 10)
+    datapath = os.path.join(
+        os.path.dirname(__file__),
+        "..",
+        "tests",
+        "data",
+        "systemlog_GetRecords.response",
+    )
+    with open(datapath, "r") as fp:
+        response = json.load(fp)
+    response["Items"] = (response["Items"] * rows)[:rows]
+    compare(f"{rows} row response", json.dumps(response).encode("utf-8"), 3)
+    print(f"Native YAML: {'libyaml' if yaml.__with_libyaml__ else 'unavailable'}")
+    # Distinct rows, as YAML would otherwise emit aliases for repeated ones
+    response["Items"] = json.loads(json.dumps(response["Items"][: rows // 10]))
+    compare_yaml(f"{rows // 10} row response", response, 1)
+
+
+if __name__ == "__main__":
+    main()
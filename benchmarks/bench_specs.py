@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""Time spec processing for a synced service.
+
+Usage: python benchmarks/bench_specs.py [service_or_path] [repetitions]
+
+Defaults to the (large) cvadrestapis spec in ~/.cxcli/apispecs. Run
+`cx --update-specs` first, so the spec is available locally, or pass the path
+of a spec file.
+"""
+
+import copy
+import gc
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.clidriver as clidriver
+import cxcli.syncspecs as syncspecs
+
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else "cvadrestapis"
+    repetitions = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    path = name
+    if not os.path.isfile(path):
+        path = os.path.join(syncspecs.APISPECPATH, f"{name}.json")
+    name = os.path.basename(name).split(".", 1)[0]
+    with open(path, "r") as fp:
+        spec = json.load(fp)
+    specs = [copy.deepcopy(spec) for _ in range(repetitions)]
+    # Otherwise every garbage collection has to walk all copies, while the CLI
+    # only ever holds one spec
+    gc.freeze()
+    start = time.perf_counter()
+    for spec in specs:
+        clidriver.patch_spec({"name": name, "spec": spec})
+    elapsed = time.perf_counter() - start
+    operations = sum(len(path) for path in specs[0]["paths"].values())
+    print(f"{name}: {operations} operations")
+    print(f"patch_spec: {elapsed / repetitions * 1000:.2f} ms per spec")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,10 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import heapq
 import json
 import logging
 import os
@@ -18,22 +24,109 @@ from rich.table import Table
 
 import csv
 import io
-import yaml
+import itertools
+import math
 import re
+import sqlite3
 import sys
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows - token refreshes are then not coordinated
+    fcntl = None
 
 from . import __version__
+from . import columnar
+from . import jsoncodec
+from . import metrics
+from . import mirror
+from . import outputfile
+from . import regions
+from . import singleflight
+from . import specbundle
 from . import syncspecs
+from . import transport
+from . import yamlcodec
 
 console = Console()
+# Progress that must not mix with the result on stdout
+errconsole = Console(stderr=True)
 log = logging.getLogger()
 
-
-def prompt_configuration():
-    config = get_configuration()
+# Parameters that get populated with the configured customer
+CUSTOMERPARAMETERS = ("customer", "customerid", "citrix-customerid")
+# Fresh access_tokens per customer - (clientid, customerid) -> (timestamp, token)
+TOKENCACHE = {}
+TOKENCACHELOCK = threading.Lock()
+# Lock files that let one process refresh a token while others wait for it, and
+# the tokens of configurations from environment variables
+TOKENPATH = os.path.join(os.path.expanduser("~"), ".cxcli", "tokens")
+# Seconds to wait for another process' token refresh
+TOKENLOCKTIMEOUT = 30
+# Seconds for which an access_token gets used
+TOKENMAXAGE = 59 * 60
+
+# Where --follow remembers the last records it printed
+CHECKPOINTPATH = os.path.join(os.path.expanduser("~"), ".cxcli", "checkpoints")
+# Record keys that --follow orders records by
+TIMESTAMPKEYS = ("UtcTimestamp", "Timestamp", "timestamp", "CreatedDate", "createdDate")
+# ISO 8601 timestamps, with any number of fractional digits, e.g. .0267962Z
+TIMESTAMPPATTERN = re.compile(
+    r"^(\d{4}-\d{2}-\d{2})[T ](\d{2}:\d{2}:\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})?$",
+    re.IGNORECASE,
+)
+
+# Keywords whose value is a schema, or a list of schemas
+SCHEMAKEYWORDS = ("items", "additionalProperties", "not")
+SCHEMALISTKEYWORDS = ("allOf", "anyOf", "oneOf")
+REFERENCEKEYWORDS = frozenset(
+    ("$ref", "properties") + SCHEMAKEYWORDS + SCHEMALISTKEYWORDS
+)
+# Query parameters of offset-based paging, and response keys with the total
+OFFSETPARAMETERS = ("$skip", "skip", "offset")
+LIMITPARAMETERS = ("$top", "top", "limit")
+TOTALKEYS = ("totalcount", "total", "totalitems", "@odata.count")
+# Pages requested ahead of the page being assembled
+PAGEWINDOW = 8
+
+# Commands that run an operation in a different way
+TOOLS = ("bench", "mirror")
+
+# Where parameters go in a request
+REQUESTPARTS = ("path", "query", "header", "body", "formData")
+
+# Seconds between polls of asynchronous jobs, growing up to the maximum
+WAITINTERVAL = 1
+WAITMAXINTERVAL = 30
+# Job states that mean the job is still running
+RUNNINGSTATES = ("notstarted", "queued", "pending", "running", "inprogress")
+STATEKEYS = ("Status", "status", "State", "state")
+
+# Rows used to infer column widths, and rows rendered at once in table output.
+# Also the rows written at once to csv output files.
+TABLESAMPLESIZE = 100
+TABLECHUNKSIZE = 1000
+TABLEMAXCOLUMNWIDTH = 60
+
+
+def prompt_configuration(profile=""):
+    config = get_configuration(profile)
     if not config:
-        config = {"clientid": None, "clientsecret": None, "customerid": None}
+        config = {
+            "clientid": None,
+            "clientsecret": None,
+            "customerid": None,
+            "region": None,
+            "profile": profile,
+        }
     while True:
+        config["region"] = Prompt.ask(
+            "Region",
+            choices=list(regions.REGIONS) + [regions.AUTOREGION],
+            default=config["region"] or regions.DEFAULTREGION,
+        )
         config["customerid"] = Prompt.ask("CustomerId", default=config["customerid"])
         config["clientid"] = Prompt.ask("ClientId", default=config["clientid"])
         config["clientsecret"] = Prompt.ask(
@@ -43,6 +136,8 @@ def prompt_configuration():
             show_default=False,
         )
         goodcredentials = True
+        # Probe again, in case the region changed
+        regions.reset_region_cache(profile)
         try:
             console.print("Validating credentials... ", end=None)
             authenticate_api(config, use_cache=False)
@@ -53,11 +148,16 @@ def prompt_configuration():
         if goodcredentials and Confirm.ask(
             "Please confirm to store this configuration in the OS keying"
         ):
-            keyring.set_password("cxcli", ":customerid", config["customerid"])
-            keyring.set_password("cxcli", ":clientid", config["clientid"])
-            keyring.set_password("cxcli", ":clientsecret", config["clientsecret"])
+            keyring.set_password("cxcli", f"{profile}:region", config["region"])
+            keyring.set_password("cxcli", f"{profile}:customerid", config["customerid"])
+            keyring.set_password("cxcli", f"{profile}:clientid", config["clientid"])
+            keyring.set_password(
+                "cxcli", f"{profile}:clientsecret", config["clientsecret"]
+            )
             # invalidate access_token
-            keyring.set_password("cxcli", ":access_token_timestamp", "0")
+            keyring.set_password(
+                "cxcli", get_token_key(config, "access_token_timestamp"), "0"
+            )
             console.print("Configuration stored successfully.", style="GREEN")
             break
 
@@ -70,19 +170,24 @@ def use_environ_keys():
     )
 
 
-def get_configuration():
+def get_configuration(profile=""):
+    # Profiles are stored side by side in the keyring, the default profile is ""
     if use_environ_keys():
         config = {
             "customerid": os.environ["CXCUSTOMERID"],
             "clientid": os.environ["CXCLIENTID"],
             "clientsecret": os.environ["CXCLIENTSECRET"],
+            "region": os.environ.get("CXREGION"),
         }
     else:
         config = {
-            "customerid": keyring.get_password("cxcli", ":customerid"),
-            "clientid": keyring.get_password("cxcli", ":clientid"),
-            "clientsecret": keyring.get_password("cxcli", ":clientsecret"),
+            "customerid": keyring.get_password("cxcli", f"{profile}:customerid"),
+            "clientid": keyring.get_password("cxcli", f"{profile}:clientid"),
+            "clientsecret": keyring.get_password("cxcli", f"{profile}:clientsecret"),
+            "region": os.environ.get("CXREGION")
+            or keyring.get_password("cxcli", f"{profile}:region"),
         }
+    config["profile"] = profile
     if (
         config["customerid"] is None
         or config["clientid"] is None
@@ -92,6 +197,23 @@ def get_configuration():
     return config
 
 
+def get_token_key(config, key):
+    # Tokens are cached per customer, so that customers don't evict each other
+    return f"{config['profile']}:{config['customerid']}:{key}"
+
+
+def get_customers(value):
+    # Customers are provided either as comma-separated list, or as file with one
+    # customer per line
+    if os.path.isfile(value):
+        with open(value, "r") as fp:
+            lines = [line.split("#", 1)[0].strip() for line in fp]
+        customers = [line for line in lines if line]
+    else:
+        customers = [customer.strip() for customer in value.split(",")]
+    return list(dict.fromkeys(customer for customer in customers if customer))
+
+
 def config_logging(level):
     logging.basicConfig(
         level=level, format="%(message)s", datefmt="[%X]", handlers=[RichHandler()]
@@ -100,30 +222,37 @@ def config_logging(level):
 
 def get_all_services():
     services = {}
-    if not os.path.exists(syncspecs.METACACHEPATH):
+    bundlepath = specbundle.get_bundle_path()
+    if bundlepath is not None:
+        # Prebuilt specs, e.g. baked into an image
+        bundle = specbundle.open_bundle(bundlepath)
+        titles = specbundle.get_titles(bundle)
+        load_spec = lambda name: specbundle.load_spec(bundle, name)
+    elif not os.path.exists(syncspecs.METACACHEPATH):
         # Specs not synced yet, return empty dict
         return services
-    with open(syncspecs.METACACHEPATH, "r") as fp:
-        metacache = json.load(fp)
-    for filename in sorted(os.listdir(syncspecs.APISPECPATH)):
-        if not filename.endswith(".json"):
-            continue
+    else:
+        metacache = jsoncodec.load_file(syncspecs.METACACHEPATH)
+        titles = {
+            filename.split(".", 1)[0]: metacache.get(filename.replace(".json", ""), "")
+            for filename in os.listdir(syncspecs.APISPECPATH)
+            if filename.endswith(".json")
+        }
+        load_spec = lambda name: jsoncodec.load_file(
+            os.path.join(syncspecs.APISPECPATH, name + ".json")
+        )
+    for name in sorted(titles):
         service = {}
-        service["name"] = filename.split(".", 1)[0]
+        service["name"] = name
         namesplit = service["name"].split("_")
         if namesplit[0] in sys.argv and (
             len(namesplit) < 2 or namesplit[1] in sys.argv
         ):
             # Performance Tweak: Only load service JSON-files, when we'll use them
-            with open(os.path.join(syncspecs.APISPECPATH, filename), "r") as read_file:
-                service["spec"] = json.load(read_file)
+            service["spec"] = load_spec(name)
             patch_spec(service)
         else:
-            try:
-                title = metacache[filename.replace(".json", "")]
-            except KeyError:
-                title = ""
-            service["spec"] = {"info": {"title": title}, "paths": {}}
+            service["spec"] = {"info": {"title": titles[name]}, "paths": {}}
         services[service["name"]] = service
     return services
 
@@ -137,46 +266,22 @@ def patch_spec(service):
     if "basePath" in service["spec"]:
         service["url"] += service["spec"]["basePath"]
 
-    operationids = list()
+    # Created before the definitions get purged, for the response schemas
+    get_reference_resolver(service)
+    operationids = {
+        (path, method): operationid
+        for (path, method, operationid) in syncspecs.get_operations(service["spec"])
+    }
     purgepaths = list()
     for path, pathvalue in service["spec"]["paths"].items():
         purgemethods = list()
         for method, methodvalue in pathvalue.items():
-            if method not in ("get", "post", "delete", "patch", "put"):
+            if (path, method) not in operationids:
+                # Not an operation, or one the CLI doesn't offer
+                log.debug(f"For {service['url']} skipping {path} {method}")
                 purgemethods.append(method)
                 continue
-            # Todo: Try to protect against empty operationIds, like the administrators API
-            if "operationId" not in methodvalue:
-                if "summary" in methodvalue:
-                    methodvalue["operationId"] = re.sub(
-                        "[^a-zA-Z ]+", "", methodvalue["summary"]
-                    )
-                else:
-                    log.debug(
-                        f"For {service['url']} skipping {path} {method} as there is no operationId"
-                    )
-                    purgemethods.append(method)
-                    continue
-
-            # Skip "ping" operations and operations that indicate that they will only work with ServiceKey
-            if "ping" in methodvalue["operationId"].lower() or (
-                "summary" in methodvalue
-                and "[ServiceKey]" in methodvalue["summary"]
-                and "[BearerToken]" not in methodvalue["summary"]
-            ):
-                purgemethods.append(method)
-                continue
-
-            # ToDo: Tweak awkward operationIds, like Microapps', to not contain spaces
-            methodvalue["operationId"] = methodvalue["operationId"].replace(" ", "_")
-
-            # ToDo: Work around duplicate operationIds, like in agenthub by renaming
-            if methodvalue["operationId"] in operationids:
-                counter = 2
-                while methodvalue["operationId"] + str(counter) in operationids:
-                    counter += 1
-                methodvalue["operationId"] = methodvalue["operationId"] + str(counter)
-            operationids.append(methodvalue["operationId"])
+            methodvalue["operationId"] = operationids[(path, method)]
 
             # Resolve references in spec
             newparameters = list()
@@ -273,6 +378,10 @@ def populate_argpars_operation(
     alloperations[originalname][operation_id]["url"] = (
         "https://" + service["url"] + path
     )
+    # Keep the resolver, so that response schemas can be resolved when needed
+    alloperations[originalname][operation_id]["reference_resolver"] = (
+        get_reference_resolver(service)
+    )
     help = requestspec["summary"] if "summary" in requestspec else None
     command_parser = command_subparser.add_parser(
         operation_id,
@@ -304,6 +413,60 @@ def populate_argpars_operation(
         help="Filter the result using JMESPath (See https://jmespath.org/tutorial.html)",
         default=argparse.SUPPRESS,
     )
+    command_parser.add_argument(
+        "--columns",
+        help="Comma-separated list of columns to show for table and csv output",
+        type=lambda value: [column.strip() for column in value.split(",")],
+        default=None,
+    )
+    command_parser.add_argument(
+        "--output-file",
+        help="Write the result to a file instead, in the --output-as format (json, yaml or csv), or as typed columns for .parquet, .arrow or .feather files. Compressed for .gz, .zst or .xz",
+        metavar="path_to_file",
+        default=argparse.SUPPRESS,
+    )
+    command_parser.add_argument(
+        "--pager",
+        help="Show table output in a pager",
+        action="store_true",
+        default=argparse.SUPPRESS,
+    )
+    if requesttype == "get":
+        command_parser.add_argument(
+            "--watch",
+            help="Repeat the operation every number of seconds and only show changes",
+            type=float,
+            metavar="seconds",
+            default=argparse.SUPPRESS,
+        )
+    else:
+        command_parser.add_argument(
+            "--wait",
+            help="Wait for asynchronous jobs (202 Accepted) to finish, for up to the number of seconds",
+            type=float,
+            nargs="?",
+            const=3600,
+            metavar="seconds",
+            default=argparse.SUPPRESS,
+        )
+    if get_paging_parameters(requestspec) is not None:
+        command_parser.add_argument(
+            "--all-pages",
+            help=f"Fetch all pages, requesting up to {PAGEWINDOW} pages concurrently",
+            action="store_true",
+            default=argparse.SUPPRESS,
+        )
+    if get_follow_parameters(requestspec) is not None:
+        command_parser.add_argument(
+            "--follow",
+            help="Keep fetching new records every number of seconds, and print them as NDJSON."
+            + " Continues after the last record printed before. Use 0 to fetch new records once.",
+            type=float,
+            nargs="?",
+            const=60,
+            metavar="seconds",
+            default=argparse.SUPPRESS,
+        )
 
 
 def populate_argpars_parameter(parameter, config, command_parser):
@@ -364,11 +527,7 @@ def populate_argpars_parameter_element(
         if isbool:
             element["type"] = "boolean"
     if element["type"] in ("string", "integer", "number", "file"):
-        if config is not None and elementkey.lower() in (
-            "customer",
-            "customerid",
-            "citrix-customerid",
-        ):
+        if config is not None and elementkey.lower() in CUSTOMERPARAMETERS:
             # Populate customerid where possible
             parameter_default = config["customerid"]
         elif elementkey == "isCloud":
@@ -431,31 +590,110 @@ def get_help_from_element(parameter):
     return help
 
 
+def get_reference_resolver(service):
+    # The resolved definitions are shared by all operations of the service
+    if "reference_resolver" not in service:
+        service["reference_resolver"] = {
+            "definitions": service["spec"].get("definitions", {}),
+            "parameters": service["spec"].get("parameters", {}),
+            "resolving": [],
+            "cyclic": set(),
+            "resolved": {},
+        }
+    return service["reference_resolver"]
+
+
+def resolve_openapi_definition(resolver, ref):
+    # A definition that is reached again while it's being resolved is on a
+    # cycle, as is every definition resolved since
+    resolving = resolver["resolving"]
+    if ref in resolving:
+        resolver["cyclic"].update(resolving[resolving.index(ref) :])
+        return None
+    resolving.append(ref)
+    try:
+        resolved = resolve_openapi_schema(resolver, resolver["definitions"][ref])
+    finally:
+        resolving.pop()
+    if ref in resolver["cyclic"]:
+        return None
+    resolver["resolved"][ref] = resolved
+    return resolved
+
+
+def resolve_openapi_schema(resolver, node):
+    # Only the keywords that hold schemas get followed, so that e.g. examples
+    # stay as they are
+    if not isinstance(node, dict):
+        return node
+    if "$ref" in node and isinstance(node["$ref"], str):
+        ref = node["$ref"].split("/")[-1]
+        if ref in resolver["resolved"]:
+            return resolver["resolved"][ref]
+        if ref not in resolver["definitions"] or ref in resolver["cyclic"]:
+            # Unknown and self-referencing definitions can't be inlined
+            return node
+        resolved = resolve_openapi_definition(resolver, ref)
+        return node if resolved is None else resolved
+    resolved = None
+    for key, value in node.items():
+        if key in SCHEMAKEYWORDS:
+            newvalue = resolve_openapi_schema(resolver, value)
+        elif key == "properties" and isinstance(value, dict):
+            newvalue = resolve_openapi_schemas(resolver, value, value.items())
+        elif key in SCHEMALISTKEYWORDS and isinstance(value, list):
+            newvalue = resolve_openapi_schemas(resolver, value, enumerate(value))
+        else:
+            continue
+        if newvalue is not value:
+            if resolved is None:
+                resolved = dict(node)
+            resolved[key] = newvalue
+    # Only copy the nodes that changed, share everything else
+    return node if resolved is None else resolved
+
+
+def resolve_openapi_schemas(resolver, container, entries):
+    resolved = None
+    for key, value in entries:
+        if isinstance(value, dict) and REFERENCEKEYWORDS.isdisjoint(value):
+            # Most properties are plain, e.g. strings
+            continue
+        newvalue = resolve_openapi_schema(resolver, value)
+        if newvalue is not value:
+            if resolved is None:
+                resolved = container.copy()
+            resolved[key] = newvalue
+    return container if resolved is None else resolved
+
+
+def get_response_schema(aspec):
+    for code in ("200", "201", "202", "default"):
+        response = aspec.get("responses", {}).get(code)
+        if isinstance(response, dict) and "schema" in response:
+            return resolve_openapi_schema(
+                aspec["reference_resolver"], response["schema"]
+            )
+    return None
+
+
 def resolve_openapi_references(service, parameter):
-    change = True
-    while change:
-        change = False
-        if "$ref" in parameter:
-            ref = parameter["$ref"].split("/")[-1]
-            parameter = service["spec"]["parameters"][ref]
-            change = True
-        if "schema" in parameter:
-            if "$ref" in parameter["schema"]:
-                ref = parameter["schema"]["$ref"].split("/")[-1]
-                parameter["schema"] = service["spec"]["definitions"][ref]
-                change = True
-            if "properties" in parameter["schema"]:
-                newproperties = {}
-                for propertykey, propertyvalue in parameter["schema"][
-                    "properties"
-                ].items():
-                    if "$ref" in propertyvalue:
-                        ref = propertyvalue["$ref"].split("/")[-1]
-                        newproperties[propertykey] = service["spec"]["definitions"][ref]
-                        change = True
-                    else:
-                        newproperties[propertykey] = propertyvalue
-                parameter["schema"]["properties"] = newproperties
+    if "$ref" not in parameter and "schema" not in parameter:
+        # e.g. query and header parameters
+        return parameter
+    resolver = get_reference_resolver(service)
+    seen = set()
+    while "$ref" in parameter:
+        ref = parameter["$ref"].split("/")[-1]
+        if ref in seen or ref not in resolver["parameters"]:
+            break
+        seen.add(ref)
+        parameter = resolver["parameters"][ref]
+    if "schema" in parameter:
+        schema = resolve_openapi_schema(resolver, parameter["schema"])
+        if schema is not parameter["schema"]:
+            parameter = dict(parameter)
+            parameter["schema"] = schema
     return parameter
 
 
@@ -487,144 +725,412 @@ def process_openapi_specs(all_services, alloperations, command_subparsers, confi
             populate_argpars_service(alloperations, command_subparsers, service, config)
 
 
-def get_value(atype, aspec, args):
-    adict = {}
+def compile_request_builder(aspec):
+    """Map the operation's parameters to the parts of a request, once
+
+    The result is kept in the operation spec and reused by build_request.
+    """
+    parameters = []
     for parameter in aspec["parameters"]:
-        if "in" not in parameter or parameter["in"] != atype:
+        if parameter.get("in") not in REQUESTPARTS:
             continue
-        argname = parameter["name"].replace("-", "_")
-        if hasattr(args, argname):
-            # It's a simple value
-            value = getattr(args, argname)
-            if value is not None:
-                adict[parameter["name"]] = value
-        elif "schema" in parameter and "properties" in parameter["schema"]:
-            # It's a more complex structure.. so we need to put a dict together
+        elements = None
+        if "schema" in parameter and "properties" in parameter["schema"]:
+            # A more complex structure, which gets put together from its elements
+            elements = []
             for elementkey, element in parameter["schema"]["properties"].items():
                 if not isinstance(element, dict):
                     # It's not a complex object - move on
                     break
-
-                if element["type"] == "object":
+                if element.get("type") == "object":
                     if "properties" in element:
-                        adict[elementkey] = {}
-                        for propertykey in element["properties"].keys():
-                            argname = f"{elementkey}_{propertykey}".replace("-", "_")
-                            try:
-                                value = getattr(args, argname)
-                                if value is not None:
-                                    adict[elementkey][propertykey] = value
-                            except AttributeError:
-                                pass
-                elif element["type"] in (
+                        elements.append(
+                            (
+                                elementkey,
+                                [
+                                    (
+                                        propertykey,
+                                        f"{elementkey}_{propertykey}".replace("-", "_"),
+                                    )
+                                    for propertykey in element["properties"]
+                                ],
+                            )
+                        )
+                elif element.get("type") in (
                     "string",
                     "integer",
                     "number",
                     "array",
                     "boolean",
                 ):
-                    argname = elementkey.replace("-", "_")
-                    try:
-                        value = getattr(args, argname)
+                    elements.append((elementkey, elementkey.replace("-", "_")))
+                else:
+                    log.error(f"Unhandled element type {element.get('type')}")
+        parameters.append(
+            (
+                parameter["in"],
+                parameter["name"],
+                parameter["name"].replace("-", "_"),
+                elements,
+            )
+        )
+    url = urllib.parse.urlsplit(aspec["url"])
+    # Literals at even, and path parameter names at odd indexes
+    template = re.split(
+        r"\{([^}]*)\}", urllib.parse.urlunsplit(("", "", url.path, url.query, ""))
+    )
+    return {
+        "parameters": parameters,
+        "scheme": url.scheme,
+        "netloc": url.netloc,
+        "template": template,
+    }
+
+
+def get_request_parts(builder, args):
+    # All parts in a single pass over the parameters
+    parts = {part: {} for part in REQUESTPARTS}
+    for part, name, argname, elements in builder["parameters"]:
+        adict = parts[part]
+        if hasattr(args, argname):
+            # It's a simple value
+            value = getattr(args, argname)
+            if value is not None:
+                adict[name] = value
+        elif elements is not None:
+            for elementkey, argnames in elements:
+                if isinstance(argnames, list):
+                    adict[elementkey] = {}
+                    for propertykey, propertyargname in argnames:
+                        value = getattr(args, propertyargname, None)
                         if value is not None:
-                            if atype == "body" and isinstance(value, list):
-                                # ToDo: not sure about doing it this way, but seems neded for Notification post
-                                try:
-                                    valuelist = value
-                                    value = list()
-                                    for entry in valuelist:
-                                        value.append(json.loads(entry))
-                                except json.JSONDecodeError:
-                                    pass
-                            adict[elementkey] = value
-                    except AttributeError:
+                            adict[elementkey][propertykey] = value
+                    continue
+                value = getattr(args, argnames, None)
+                if value is None:
+                    continue
+                if part == "body" and isinstance(value, list):
+                    # ToDo: not sure about doing it this way, but seems neded for Notification post
+                    try:
+                        value = [jsoncodec.loads(entry) for entry in value]
+                    except json.JSONDecodeError:
                         pass
-                else:
-                    log.error(f"Unhandled element type {element['type']}")
-    return adict
+                adict[elementkey] = value
+    return parts
 
 
 class AuthenticationException(Exception):
     pass
 
 
-def authenticate_api(config, use_cache=True):
-    access_token = None
-    if not use_environ_keys():
-        # Only rely on keyring if environment keys not used
-        timestamp = keyring.get_password("cxcli", ":access_token_timestamp")
-        if timestamp and int(timestamp) + 59 * 60 > time.time():
-            # we can use cached access_tokens for up to 59m
-            access_token = keyring.get_password("cxcli", ":access_token")
-    if not use_cache or access_token is None:
-        # get a fresh access_token
-        auth_data = {}
-        auth_data["grant_type"] = "client_credentials"
-        auth_data["client_id"] = config["clientid"]
-        auth_data["client_secret"] = config["clientsecret"]
-        headers = get_default_headers()
-        headers.update(
-            {
-                "Content-Type": "application/x-www-form-urlencoded",
-                "Accept": "application/json",
-            }
-        )
-        trust_uri = f"https://api-us.cloud.com/cctrustoauth2/{config['customerid']}/tokens/clients"
-        response = requests.post(trust_uri, headers=headers, data=auth_data)
-        if response.status_code == 200:
-            result = response.json()
-        else:
-            raise AuthenticationException(
-                "Failed to authenticate with Citrix Cloud."
-                + " Return code: %d" % (response.status_code)
-                + response.text
+def get_token_path(config):
+    # Hashed, to keep the customer and client out of file names
+    key = f"{config['profile']}:{config['clientid']}:{config['customerid']}"
+    return os.path.join(TOKENPATH, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+
+@contextlib.contextmanager
+def lock_token(config):
+    # Advisory lock, so that only one process refreshes the token
+    path = get_token_path(config) + ".lock"
+    os.makedirs(TOKENPATH, exist_ok=True)
+    with open(path, "a") as lockfile:
+        if fcntl is not None:
+            deadline = time.time() + TOKENLOCKTIMEOUT
+            while True:
+                try:
+                    fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.time() > deadline:
+                        log.warning("Timed out waiting for another token refresh")
+                        break
+                    time.sleep(0.1)
+        yield
+
+
+def read_stored_token(config):
+    """Return (timestamp, access_token) from the keyring or token file, or None"""
+    if use_environ_keys():
+        try:
+            stored = jsoncodec.load_file(get_token_path(config) + ".json")
+        except (FileNotFoundError, ValueError):
+            return None
+        if not isinstance(stored, dict):
+            return None
+        timestamp, access_token = stored.get("timestamp"), stored.get("access_token")
+    else:
+        timestamp = keyring.get_password(
+            "cxcli", get_token_key(config, "access_token_timestamp")
+        )
+        access_token = None
+        if timestamp:
+            access_token = keyring.get_password(
+                "cxcli", get_token_key(config, "access_token")
             )
-        access_token = result["access_token"]
-        if use_cache and not use_environ_keys():
-            keyring.set_password("cxcli", ":access_token", access_token)
-            keyring.set_password(
-                "cxcli", ":access_token_timestamp", str(int(time.time()))
+    # Malformed entries are treated like missing ones, and get replaced
+    try:
+        timestamp = int(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if not access_token or timestamp + TOKENMAXAGE <= time.time():
+        return None
+    return timestamp, access_token
+
+
+def store_token(config, timestamp, access_token):
+    if use_environ_keys():
+        # Readable by the user only, like the keyring
+        path = get_token_path(config) + ".json"
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(
+                jsoncodec.dumpb({"timestamp": timestamp, "access_token": access_token})
             )
+        os.replace(path + ".tmp", path)
+    else:
+        keyring.set_password(
+            "cxcli", get_token_key(config, "access_token"), access_token
+        )
+        keyring.set_password(
+            "cxcli", get_token_key(config, "access_token_timestamp"), str(timestamp)
+        )
+
+
+def refresh_access_token(config):
+    with lock_token(config):
+        # Another process may have refreshed the token while we waited
+        stored = read_stored_token(config)
+        if stored is None:
+            stored = (int(time.time()), request_access_token(config))
+            store_token(config, *stored)
+    with TOKENCACHELOCK:
+        TOKENCACHE[(config["clientid"], config["customerid"])] = stored
+    return stored[1]
+
+
+def authenticate_api(config, use_cache=True):
+    access_token = None
+    cachekey = (config["clientid"], config["customerid"])
+    with TOKENCACHELOCK:
+        if (
+            cachekey in TOKENCACHE
+            and TOKENCACHE[cachekey][0] + TOKENMAXAGE > time.time()
+        ):
+            access_token = TOKENCACHE[cachekey][1]
+    if not use_cache:
+        access_token = request_access_token(config)
+    elif access_token is None:
+        # Concurrent callers for the same customer share one refresh
+        access_token = singleflight.do(
+            ("authenticate",) + cachekey, lambda: refresh_access_token(config)
+        )
     return {
         "Authorization": ("CwsAuth bearer=%s" % (access_token)),
         "Accept": "application/json",
     }
 
 
+def request_access_token(config):
+    auth_data = {}
+    auth_data["grant_type"] = "client_credentials"
+    auth_data["client_id"] = config["clientid"]
+    auth_data["client_secret"] = config["clientsecret"]
+    headers = get_default_headers()
+    headers.update(
+        {
+            "Content-Type": "application/x-www-form-urlencoded",
+            "Accept": "application/json",
+        }
+    )
+    trust_uri = f"https://{regions.get_api_host(config)}/cctrustoauth2/{config['customerid']}/tokens/clients"
+    with metrics.operation("authenticate"):
+        response = transport.get_session().post(
+            trust_uri, headers=headers, data=auth_data
+        )
+    if response.status_code == 200:
+        result = jsoncodec.loads(response.content)
+    else:
+        raise AuthenticationException(
+            "Failed to authenticate with Citrix Cloud."
+            + " Return code: %d" % (response.status_code)
+            + response.text
+        )
+    metrics.count("cxcli_token_refreshes_total")
+    return result["access_token"]
+
+
 def tryconvert_result_to_list(inputdict):
+    if isinstance(inputdict, list):
+        # e.g. the result of a cliquery projection
+        return inputdict
     if len(inputdict) < 1:
         return inputdict
-    if len(inputdict) == 1:
-        # There is only one key in the current response... let's dive in there
-        return next(iter(inputdict.values()))
-    elif "items" in inputdict:
-        return inputdict["items"]
-    elif "Items" in inputdict:
-        return inputdict["Items"]
-    else:
+    key = get_rows_key(inputdict)
+    if key is None:
         log.error(
             "Not sure how to convert the result to rows. Falling back to 'rawprint'-mode."
         )
         return None
+    return inputdict[key]
 
 
-def generate_table(inputdict):
+def get_rows_key(inputdict):
+    if len(inputdict) == 1:
+        # There is only one key in the current response... let's dive in there
+        return next(iter(inputdict))
+    elif "items" in inputdict:
+        return "items"
+    elif "Items" in inputdict:
+        return "Items"
+    return None
+
+
+def get_schema_columns(rowschema, prefix=""):
+    # Nested objects become dotted columns
+    columns = []
+    for key, propertyschema in rowschema.items():
+        if isinstance(propertyschema, dict) and propertyschema.get("properties"):
+            columns += get_schema_columns(
+                propertyschema["properties"], f"{prefix}{key}."
+            )
+        else:
+            columns.append(prefix + key)
+    return columns
+
+
+def add_row_columns(row, columns, prefix=""):
+    for key, value in row.items():
+        if isinstance(value, dict) and value:
+            add_row_columns(value, columns, f"{prefix}{key}.")
+        else:
+            columns.setdefault(prefix + key)
+
+
+def get_columns(rows, rowschema=None):
+    # Columns declared in the response schema come first. Rows don't necessarily
+    # share the same keys, so collect them all.
+    columns = {}
+    if rowschema:
+        columns = dict.fromkeys(get_schema_columns(rowschema))
+    for row in rows:
+        if isinstance(row, dict):
+            add_row_columns(row, columns)
+        else:
+            columns.setdefault("value")
+    return list(columns)
+
+
+def format_cell(value):
+    if value is None:
+        return ""
+    elif isinstance(value, str):
+        return value
+    elif isinstance(value, list):
+        if not any(isinstance(entry, (dict, list)) for entry in value):
+            return ", ".join(format_cell(entry) for entry in value)
+        return jsoncodec.dumps(value)
+    elif isinstance(value, dict):
+        return jsoncodec.dumps(value)
+    return str(value)
+
+
+def get_column_getter(column):
+    path = column.split(".")
+    if len(path) == 1:
+        return lambda row: row.get(column)
+
+    def get(row):
+        # Keys may contain dots themselves, e.g. @odata.type
+        if column in row:
+            return row[column]
+        value = row
+        for key in path:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(key)
+        return value
+
+    return get
+
+
+def compile_row_extractor(columns):
+    """Return a function that turns a row into its cells for the columns
+
+    Column paths get resolved once, rather than for every row.
+    """
+    getters = [get_column_getter(column) for column in columns]
+    valueindex = columns.index("value") if "value" in columns else None
+
+    def extract(row):
+        if isinstance(row, dict):
+            return [format_cell(getter(row)) for getter in getters]
+        cells = [""] * len(columns)
+        if valueindex is not None:
+            cells[valueindex] = format_cell(row)
+        return cells
+
+    return extract
+
+
+def generate_table(inputdict, columns=None, rowschema=None):
+    # Yields one table per chunk of rows, so that printing can start before all
+    # rows have been processed. Column widths are inferred from a bounded sample
+    # instead of measuring every cell.
     adict = tryconvert_result_to_list(inputdict)
     if adict is None:
-        return inputdict
-    table = Table(show_header=True, header_style="bold magenta")
-    if len(adict) == 0:
-        table = "Empty response"
+        yield inputdict
+        return
+    yield from generate_table_rows(adict, columns, rowschema)
+
+
+def generate_table_rows(rows, columns=None, rowschema=None):
+    # Rows may be any iterable, e.g. of pages that are still being fetched. The
+    # columns of those get inferred from the first rows, as the header comes first.
+    if columns is None and isinstance(rows, list):
+        columns = get_columns(rows, rowschema)
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, TABLESAMPLESIZE))
+    if len(sample) == 0:
+        yield "Empty response"
+        return
+    if columns is None:
+        columns = get_columns(sample, rowschema)
+        rows = warn_about_new_keys(rows, columns)
+    extract = compile_row_extractor(columns)
+    samplecells = [extract(row) for row in sample]
+    widths = {}
+    for index, column in enumerate(columns):
+        cells = (len(cells[index]) for cells in samplecells)
+        widths[column] = min(max(len(column), *cells), TABLEMAXCOLUMNWIDTH)
+    chunk = sample
+    first = True
+    while len(chunk) > 0:
+        table = Table(show_header=first, header_style="bold magenta")
+        for column in columns:
+            table.add_column(column, width=widths[column], overflow="fold")
+        for row in chunk:
+            table.add_row(*extract(row))
+        yield table
+        first = False
+        chunk = list(itertools.islice(rows, TABLECHUNKSIZE))
+
+
+def print_table(inputdict, columns=None, pager=False, rowschema=None):
+    print_renderables(generate_table(inputdict, columns, rowschema), pager)
+
+
+def print_renderables(renderables, pager=False):
+    if pager:
+        with console.pager(styles=True):
+            for renderable in renderables:
+                console.print(renderable)
     else:
-        for key in next(iter(adict)):
-            table.add_column(key)
-        for row in adict:
-            row = map(str, row.values())
-            table.add_row(*row)
-    return table
+        for renderable in renderables:
+            console.print(renderable)
 
 
-def generate_csv(inputdict):
+def generate_csv(inputdict, columns=None, rowschema=None):
     adict = tryconvert_result_to_list(inputdict)
     if adict is None:
         return inputdict
@@ -633,13 +1139,12 @@ def generate_csv(inputdict):
 
     output = io.StringIO()
     spamwriter = csv.writer(output, dialect="excel")
-    columns = list()
-    for key in next(iter(adict)):
-        columns.append(key)
+    if columns is None:
+        columns = get_columns(adict, rowschema)
+    extract = compile_row_extractor(columns)
     spamwriter.writerow(columns)
     for row in adict:
-        row = map(str, row.values())
-        spamwriter.writerow(row)
+        spamwriter.writerow(extract(row))
     return output.getvalue()
 
 
@@ -651,6 +1156,76 @@ def main():
         return 255
 
 
+def get_tool_parser(tool):
+    toolparser = argparse.ArgumentParser(
+        prog=f"cx {tool}",
+        usage=f"cx {tool} [options] service operation [parameters]",
+    )
+    if tool == "bench":
+        toolparser.add_argument(
+            "--requests", help="Number of requests to send", type=int, default=100
+        )
+        toolparser.add_argument(
+            "--concurrency", help="Number of requests in flight", type=int, default=8
+        )
+    elif tool == "mirror":
+        toolparser.add_argument(
+            "--index",
+            help="Comma-separated list of fields to store as indexed columns",
+            type=lambda value: [field.strip() for field in value.split(",")],
+            default=[],
+        )
+        toolparser.add_argument(
+            "--local",
+            help="Query the mirror instead of syncing it, e.g. with --cliquery",
+            action="store_true",
+        )
+        toolparser.add_argument(
+            "--sql", help="Query the mirror using SQL instead of syncing it"
+        )
+    return toolparser
+
+
+def get_positional_index(parser, argv, start=0):
+    # The index of the first argument that isn't one of the parser's options,
+    # or one of their values
+    index = start
+    while index < len(argv):
+        argument = argv[index]
+        if not argument.startswith("-"):
+            return index
+        index += 1
+        action = parser._option_string_actions.get(argument)
+        if action is None or action.nargs == 0:
+            # Unknown options, flags and --option=value
+            continue
+        if action.nargs in ("+", "*"):
+            while index < len(argv) and not argv[index].startswith("-"):
+                index += 1
+        else:
+            index += 1
+    return None
+
+
+def split_tool_arguments(parser, argv):
+    """Return the tool, its arguments, and the arguments for the parser
+
+    'cx [options] bench|mirror [tool options] service operation ...' runs the
+    operation as a tool. Tool options only go before the service, so that they
+    can't be mistaken for parameters of the operation.
+    """
+    index = get_positional_index(parser, argv)
+    if index is None or argv[index] not in TOOLS:
+        return (None, None, argv)
+    tool = argv[index]
+    toolparser = get_tool_parser(tool)
+    end = get_positional_index(toolparser, argv, index + 1)
+    if end is None:
+        end = len(argv)
+    toolargs = toolparser.parse_args(argv[index + 1 : end])
+    return (tool, toolargs, argv[:index] + argv[end:])
+
+
 def _main():
     parser = argparse.ArgumentParser(
         description=f"cx {__version__} - CLI for Citrix Cloud"
@@ -671,27 +1246,86 @@ def _main():
         help=argparse.SUPPRESS,
         action="store_true",
     )
+    parser.add_argument(
+        "--http2",
+        help="Multiplex requests over HTTP/2 where supported (requires httpx[http2])",
+        action="store_true",
+        default=os.environ.get("CXCLI_HTTP2", "0") not in ("", "0"),
+    )
+    parser.add_argument(
+        "--metrics-file",
+        help="Record request metrics to a Prometheus textfile (.prom), or append them as OpenTelemetry JSON spans",
+        default=os.environ.get("CXCLI_METRICS"),
+        metavar="path",
+    )
+    parser.add_argument(
+        "--export-spec-bundle",
+        help="Write the synced specs to a single read-only file, for use with CXCLI_SPEC_PATH",
+        metavar="path",
+    )
+    parser.add_argument(
+        "--search",
+        help="Search operations across all services",
+        nargs="+",
+        metavar="term",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Use the named configuration profile",
+        default=os.environ.get("CXPROFILE", ""),
+    )
+    parser.add_argument(
+        "--customers",
+        help="Run the operation for each of the comma-separated customers, or the customers listed in the file",
+        type=get_customers,
+        metavar="list_or_file",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        help="Maximum number of customers to run the operation for concurrently",
+        type=int,
+        default=8,
+    )
     command_subparsers = parser.add_subparsers(
         dest="command", help="Available Services", metavar=""
     )
-    config = get_configuration()
-    all_services = get_all_services()
+    # The profile is needed before parsing, to populate the customer defaults
+    profileparser = argparse.ArgumentParser(add_help=False)
+    profileparser.add_argument("--profile", default=os.environ.get("CXPROFILE", ""))
+    profile = profileparser.parse_known_args(sys.argv[1:])[0].profile
+    tool, toolargs, argv = split_tool_arguments(parser, sys.argv[1:])
+    config = get_configuration(profile)
+    bundlepath = specbundle.get_bundle_path()
+    try:
+        all_services = get_all_services()
+    except specbundle.SpecBundleException as exc:
+        console.print(str(exc), style="red")
+        return 2
     alloperations = {}
     process_openapi_specs(all_services, alloperations, command_subparsers, config)
     argcomplete.autocomplete(parser)
-    args = parser.parse_args(sys.argv[1:])
+    args = parser.parse_args(argv)
 
     # Deal with generic cmd-line options
     config_logging("DEBUG" if args.verbose else "WARNING")
+    transport.USEHTTP2 = args.http2
+    metrics.configure(args.metrics_file)
+    # A bundle is used as is, and never synced
+    missingspecs = bundlepath is None and len(all_services) == 0
     if (
         args.configure
         or args.update_specs
-        or len(all_services) == 0
+        or missingspecs
         or args.update_unpublished_specs
+        or args.export_spec_bundle
     ):
         if args.configure:
-            prompt_configuration()
-        if args.update_specs or len(all_services) == 0:
+            prompt_configuration(args.profile)
+        if (
+            args.update_specs
+            or missingspecs
+            or (args.export_spec_bundle and not os.path.exists(syncspecs.METACACHEPATH))
+        ):
             syncspecs.reset_synced_specs()
             console.print("Preparing API specs. Please wait...")
             syncspecs.sync_public_specs()
@@ -700,8 +1334,20 @@ def _main():
             console.print("Preparing API specs. Please wait...")
             sync_all_unpublished(config)
             console.print("Done.", style="green")
+        if args.export_spec_bundle:
+            count = specbundle.export_bundle(args.export_spec_bundle)
+            console.print(
+                f"Wrote {count} specs to {args.export_spec_bundle}", style="green"
+            )
         return 0
 
+    if bundlepath is None:
+        # Serve from the current specs, but have them refreshed for later invocations
+        syncspecs.refresh_specs_if_stale()
+
+    if args.search:
+        return search_operations(args.search)
+
     # Make sure the configuration is place
     if config is None:
         scriptname = os.path.basename(__file__)
@@ -722,11 +1368,37 @@ def _main():
             alloperations[f"{args.command}_{args.commandcomponent}"][
                 "command_parser"
             ].print_help()
+    elif tool == "bench":
+        return bench_command(alloperations, config, args, toolargs)
+    elif tool == "mirror":
+        return mirror_command(alloperations, config, args, toolargs)
     elif "command" in args and "subcommand" in args:
         return execute_command(alloperations, config, args)
     return 0
 
 
+def search_operations(terms):
+    searchindex = None
+    bundlepath = specbundle.get_bundle_path()
+    if bundlepath is not None:
+        searchindex = specbundle.load_searchindex(specbundle.open_bundle(bundlepath))
+    elif not os.path.exists(syncspecs.SEARCHINDEXPATH):
+        # Specs were synced by an older version, index them now
+        syncspecs.build_metadata()
+    matches = syncspecs.search_operations(terms, searchindex=searchindex)
+    if len(matches) == 0:
+        console.print("No matching operations found.")
+        return 1
+    table = Table(show_header=True, header_style="bold magenta")
+    for column in ("Command", "Method", "Path", "Summary"):
+        table.add_column(column)
+    for servicename, operationid, method, path, summary in matches:
+        command = " ".join(["cx"] + servicename.split("_", 1) + [operationid])
+        table.add_row(command, method, path, summary)
+    console.print(table)
+    return 0
+
+
 def get_default_headers():
     headersdict = requests.utils.default_headers()
     headersdict["User-Agent"] = "cxcli/0.1"
@@ -736,15 +1408,16 @@ def get_default_headers():
 def sync_all_unpublished(config):
     url = f"https://releasesapi.citrixworkspacesapi.net/{config['customerid']}/releases"
     headersdict = get_default_headers()
-    headersdict.update(authenticate_api(get_configuration()))
-    response = requests.get(url, headers=headersdict)
+    headersdict.update(authenticate_api(config))
+    response = transport.get_session().get(url, headers=headersdict)
     if not response.ok:
         log.error(f"Failure from {url} - {response.status_code}")
         return 2
     cc_service_urls = {}
-    for serviceinfo in response.json():
+    releasesregion = regions.REGIONS[regions.get_region(config)]["releases"]
+    for serviceinfo in jsoncodec.loads(response.content):
         if (
-            serviceinfo["region"] == "EastUS"
+            serviceinfo["region"] == releasesregion
             and serviceinfo["release"] == "release-a"
             and serviceinfo["fqdn"].endswith(".citrixworkspacesapi.net")
             and serviceinfo["service"]
@@ -791,37 +1464,76 @@ def sync_all_unpublished(config):
     syncspecs.sync_specs(cc_service_urls)
 
 
-def execute_command(alloperations, config, args):
+def get_command_key(args):
     command_key = args.command
     if "commandcomponent" in args and args.commandcomponent is not None:
         command_key += f"_{args.commandcomponent}"
-    aspec = alloperations[command_key][args.subcommand]
-    # console.print(aspec)
-    pathdict = get_value("path", aspec, args)
-    url = aspec["url"]
-    for key, value in pathdict.items():
-        url = url.replace("{" + key + "}", urllib.parse.quote_plus(value))
-    paramsdict = get_value("query", aspec, args)
+    return command_key
+
+
+def get_operation_spec(alloperations, args):
+    return alloperations[get_command_key(args)][args.subcommand]
+
+
+def build_request(aspec, config, args):
+    if "request_builder" not in aspec:
+        aspec["request_builder"] = compile_request_builder(aspec)
+    builder = aspec["request_builder"]
+    parts = get_request_parts(builder, args)
+    pathdict = parts["path"]
+    template = builder["template"]
+    path = [template[0]]
+    for index in range(1, len(template), 2):
+        name = template[index]
+        if name in pathdict:
+            path.append(urllib.parse.quote_plus(str(pathdict[name])))
+        else:
+            path.append("{" + name + "}")
+        path.append(template[index + 1])
+    # Route requests for the API gateway to the configured region
+    url = (
+        f"{builder['scheme']}://{regions.rewrite_host(builder['netloc'], config)}"
+        + "".join(path)
+    )
+    paramsdict = parts["query"]
     headersdict = get_default_headers()
-    headersdict.update(get_value("header", aspec, args))
+    headersdict.update(parts["header"])
     headersdict.update(authenticate_api(config))
-    ajsondict = get_value("body", aspec, args)
-    filesdict = get_value("formData", aspec, args)
+    ajsondict = parts["body"]
+    filesdict = parts["formData"]
     log.debug(f"Sent headers: {headersdict}")
     log.debug(f"Sent params: {paramsdict}")
     log.debug(f"Sent body: {ajsondict}")
-    response = requests.request(
-        aspec["method"],
-        url,
-        params=paramsdict,
-        headers=headersdict,
-        json=ajsondict,
-        files=filesdict,
+    return {
+        "method": aspec["method"],
+        "url": url,
+        "params": paramsdict,
+        "headers": headersdict,
+        "json": ajsondict,
+        "files": filesdict,
+    }
+
+
+def get_request_key(request):
+    return jsoncodec.dumps(
+        [request["method"], request["url"], request["params"], dict(request["headers"])]
     )
+
+
+def send_request(request, args):
+    with metrics.operation(f"{get_command_key(args)} {args.subcommand}"):
+        if request["method"].upper() in ("GET", "HEAD"):
+            # Concurrent identical reads share one response
+            response = singleflight.do(
+                get_request_key(request),
+                lambda: transport.get_session().request(**request),
+            )
+        else:
+            response = transport.get_session().request(**request)
     if response.ok:
-        log.info(f"Success from {url} - {response.status_code}")
+        log.info(f"Success from {request['url']} - {response.status_code}")
     else:
-        log.error(f"Failure from {url} - {response.status_code}")
+        log.error(f"Failure from {request['url']} - {response.status_code}")
     if args.verbose:
         headerlog = ""
         for header in response.headers.items():
@@ -829,34 +1541,1026 @@ def execute_command(alloperations, config, args):
             headerlog += f"{key}: {value}\n"
         log.debug(f"Received header: {headerlog}")
         log.debug(f"Received body: {response.text}")
+    return response
+
+
+def get_cliquery(args):
+    if "cliquery" in args and args.cliquery:
+        return jmespath.compile(args.cliquery)
+    return None
+
+
+def get_response_content(response, cliquery):
+    try:
+        responsecontent = jsoncodec.loads(response.content)
+    except json.decoder.JSONDecodeError as exc:
+        logging.info("JSON decoding failed with: " + str(exc))
+        raise
+    if cliquery is not None:
+        responsecontent = cliquery.search(responsecontent)
+    return responsecontent
+
+
+def print_result(responsecontent, args, rowschema=None):
+    if "table" == args.output_as:
+        print_table(
+            responsecontent, args.columns, "pager" in args and args.pager, rowschema
+        )
+    elif "csv" == args.output_as:
+        console.print(generate_csv(responsecontent, args.columns, rowschema))
+    elif "yaml" == args.output_as:
+        for chunk in generate_yaml_chunks(responsecontent):
+            console.print(chunk, end="")
+    elif "json" == args.output_as:
+        console.print(jsoncodec.dumps(responsecontent, indent=True))
+    elif "rawprint" == args.output_as:
+        console.print(responsecontent)
+    else:
+        assert ()
+
+
+def generate_yaml_chunks(responsecontent):
+    # Rendered item by item, so that output starts before all is rendered
+    if isinstance(responsecontent, list) and responsecontent:
+        # One document per item
+        for item in responsecontent:
+            yield yamlcodec.dump(item, explicit_start=True)
+        return
+    key = None
+    if isinstance(responsecontent, dict) and responsecontent:
+        key = get_rows_key(responsecontent)
+    if key is None or not isinstance(responsecontent[key], list):
+        yield yamlcodec.dump(responsecontent)
+        return
+    # A list within the result, e.g. Items, gets its items rendered one by one,
+    # within the one document that also keeps the other keys
+    for otherkey, value in responsecontent.items():
+        if otherkey != key or len(value) == 0:
+            yield yamlcodec.dump({otherkey: value})
+            continue
+        keyline = yamlcodec.dump({otherkey: [None]})
+        yield keyline[: keyline.rindex("- null")]
+        for item in value:
+            yield yamlcodec.dump([item])
+
+
+def generate_output_chunks(responsecontent, args, rowschema=None):
+    # Formatted output as bytes, piece by piece, bypassing the rich console
+    if "csv" == args.output_as:
+        rows = tryconvert_result_to_list(responsecontent)
+        if not isinstance(rows, list):
+            rows = [rows]
+        for chunk in generate_csv_chunks(rows, args.columns, rowschema):
+            yield chunk.encode("utf-8")
+    elif "yaml" == args.output_as:
+        for chunk in generate_yaml_chunks(responsecontent):
+            yield chunk.encode("utf-8")
+    else:
+        yield jsoncodec.dumpb(responsecontent, indent=True) + b"\n"
+
+
+def generate_csv_chunks(rows, columns=None, rowschema=None):
+    # Rows may be any iterable, e.g. of pages that are still being fetched. The
+    # columns of those get inferred from the first rows, as the header comes first.
+    if columns is None and isinstance(rows, list):
+        columns = get_columns(rows, rowschema)
+    rows = iter(rows)
+    if columns is None:
+        sample = list(itertools.islice(rows, TABLESAMPLESIZE))
+        columns = get_columns(sample, rowschema)
+        rows = itertools.chain(sample, warn_about_new_keys(rows, columns))
+    extract = compile_row_extractor(columns)
+    output = io.StringIO()
+    writer = csv.writer(output, dialect="excel")
+    writer.writerow(columns)
+    chunk = list(itertools.islice(rows, TABLECHUNKSIZE))
+    while True:
+        for row in chunk:
+            writer.writerow(extract(row))
+        yield output.getvalue()
+        output.seek(0)
+        output.truncate()
+        chunk = list(itertools.islice(rows, TABLECHUNKSIZE))
+        if len(chunk) == 0:
+            break
+
+
+def warn_about_new_keys(rows, columns):
+    # Keys that first appear after the header was written can't get a column
+    # Dotted columns stem from nested objects, or from keys like @odata.type
+    known = set(columns)
+    known.update(column.split(".", 1)[0] for column in columns)
+    for row in rows:
+        if isinstance(row, dict) and not known.issuperset(row):
+            newkeys = [key for key in row if key not in known]
+            log.warning(
+                f"Leaving out {', '.join(newkeys)}, which first appeared after the"
+                " header was written. Use --columns to include them"
+            )
+            known.update(newkeys)
+        yield row
+
+
+def write_output_file(responsecontent, args, rowschema=None):
+    if columnar.is_columnar_path(args.output_file):
+        rows = tryconvert_result_to_list(responsecontent)
+        if not isinstance(rows, list):
+            log.error("The result is not a list, so it can't be written as columns")
+            return 1
+        try:
+            columnar.write_columnar(args.output_file, rows, rowschema)
+        except ImportError as exc:
+            log.error(str(exc))
+            return 2
+        console.print(f"Wrote {len(rows)} rows to {args.output_file}.")
+        return 0
+    if args.output_as not in ("json", "yaml", "csv"):
+        log.error(f"Can't write {args.output_as} output to a file")
+        return 2
+    return write_output_chunks(
+        args, generate_output_chunks(responsecontent, args, rowschema)
+    )
+
+
+def write_output_chunks(args, chunks):
+    try:
+        outputfile.write_chunks(args.output_file, chunks)
+    except (ImportError, OSError) as exc:
+        log.error(str(exc))
+        return 2
+    console.print(f"Wrote result to {args.output_file}.")
+    return 0
+
+
+def execute_command(alloperations, config, args):
+    aspec = get_operation_spec(alloperations, args)
+    try:
+        cliquery = get_cliquery(args)
+    except jmespath.exceptions.ParseError as error:
+        log.error("Invalid cliquery syntax - " + str(error))
+        return 1
+    if "customers" in args and args.customers:
+        if "watch" in args or "follow" in args or "all_pages" in args:
+            log.error(
+                "--watch, --follow and --all-pages can't be used with multiple customers"
+            )
+            return 2
+        return execute_command_for_customers(aspec, config, args, cliquery)
+    if "all_pages" in args:
+        return all_pages_command(aspec, config, args, cliquery)
+    if "watch" in args:
+        return watch_command(aspec, config, args, cliquery)
+    if "follow" in args:
+        return follow_command(aspec, config, args)
+    request = build_request(aspec, config, args)
+    response = send_request(request, args)
+    job = get_job(request, response) if "wait" in args else None
+    if job is not None:
+        _, response = next(wait_for_jobs({config["customerid"]: job}, args))
+        if response is None:
+            log.error(f"Timed out waiting for the job at {job['url']}")
+            return 255
     if "output_binary" in args and args.output_binary:
         args.output_binary.write(response.content)
         console.print(f"Wrote result to {args.output_binary.name}.")
     else:
         try:
-            responsecontent = response.json()
-        except json.decoder.JSONDecodeError as exc:
-            logging.info("JSON decoding failed with: " + str(exc))
-            responsecontent = response.text
-
-            console.print(responsecontent)
+            responsecontent = get_response_content(response, cliquery)
+        except json.decoder.JSONDecodeError:
+            console.print(response.text)
             return 1
-        if "cliquery" in args and args.cliquery:
-            try:
-                responsecontent = jmespath.search(args.cliquery, responsecontent)
-            except jmespath.exceptions.ParseError as error:
-                log.error("Invalid cliquery syntax - " + str(error))
-                return 1
-        if "table" == args.output_as:
-            console.print(generate_table(responsecontent))
-        elif "csv" == args.output_as:
-            console.print(generate_csv(responsecontent))
-        elif "yaml" == args.output_as:
-            console.print(yaml.safe_dump(responsecontent, sort_keys=False))
-        elif "json" == args.output_as:
-            console.print(json.dumps(responsecontent, indent=2))
-        elif "rawprint" == args.output_as:
-            console.print(responsecontent)
-        else:
-            assert ()
+        rc = output_result(responsecontent, aspec, args, cliquery)
+        if rc != 0:
+            return rc
     return 0 if response.ok else 255
+
+
+def output_result(responsecontent, aspec, args, cliquery):
+    # The response schema only describes the rows without a cliquery
+    rowschema = None
+    if cliquery is None and (
+        args.output_as in ("table", "csv") or "output_file" in args
+    ):
+        rowschema = columnar.get_row_schema(get_response_schema(aspec))
+    if "output_file" in args:
+        return write_output_file(responsecontent, args, rowschema)
+    print_result(responsecontent, args, rowschema)
+    return 0
+
+
+def get_customer_args(args, customerid):
+    customerargs = argparse.Namespace(**vars(args))
+    for argname in vars(args):
+        if argname.lower().replace("_", "-") in CUSTOMERPARAMETERS:
+            setattr(customerargs, argname, customerid)
+    return customerargs
+
+
+def execute_command_for_customer(aspec, config, args, cliquery, customerid, jobs):
+    customerconfig = dict(config, customerid=customerid)
+    try:
+        request = build_request(
+            aspec, customerconfig, get_customer_args(args, customerid)
+        )
+        response = send_request(request, args)
+        job = get_job(request, response) if "wait" in args else None
+        if job is not None:
+            # Waited for together with the other customers' jobs
+            jobs[customerid] = job
+            return (True, None)
+        return (response.ok, get_response_content(response, cliquery))
+    except AuthenticationException as exc:
+        log.error(f"{customerid}: {exc}")
+    except json.decoder.JSONDecodeError:
+        log.error(f"{customerid}: Unexpected response - {response.text}")
+    except requests.RequestException as exc:
+        log.error(f"{customerid}: Request failed - {exc}")
+    return (False, None)
+
+
+def execute_command_for_customers(aspec, config, args, cliquery):
+    if "output_binary" in args and args.output_binary:
+        log.error("--output-binary can't be used with multiple customers")
+        return 2
+    results = {}
+    jobs = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, args.max_concurrency)
+    ) as executor:
+        futures = {
+            executor.submit(
+                execute_command_for_customer,
+                aspec,
+                config,
+                args,
+                cliquery,
+                customerid,
+                jobs,
+            ): customerid
+            for customerid in args.customers
+        }
+        for future in concurrent.futures.as_completed(futures):
+            results[futures[future]] = future.result()
+    # Jobs are only recorded with --wait
+    for customerid, response in wait_for_jobs(jobs, args) if jobs else ():
+        if response is None:
+            log.error(f"{customerid}: Timed out waiting for the job")
+            results[customerid] = (False, None)
+            continue
+        errconsole.print(f"{customerid}: Job finished - {response.status_code}")
+        try:
+            results[customerid] = (
+                response.ok,
+                get_response_content(response, cliquery),
+            )
+        except json.decoder.JSONDecodeError:
+            log.error(f"{customerid}: Unexpected response - {response.text}")
+            results[customerid] = (False, None)
+    # Keep the order in which customers were provided
+    results = {customerid: results[customerid] for customerid in args.customers}
+    if args.output_as in ("table", "csv") or "output_file" in args:
+        # Tag every row with the customer it belongs to
+        merged = []
+        for customerid, (_, responsecontent) in results.items():
+            rows = None
+            if responsecontent is not None:
+                rows = tryconvert_result_to_list(responsecontent)
+            if not isinstance(rows, list):
+                rows = [] if responsecontent is None else [responsecontent]
+            for row in rows:
+                if not isinstance(row, dict):
+                    row = {"value": row}
+                taggedrow = {"CustomerId": customerid}
+                taggedrow.update(row)
+                taggedrow["CustomerId"] = customerid
+                merged.append(taggedrow)
+    else:
+        merged = {
+            customerid: responsecontent
+            for customerid, (_, responsecontent) in results.items()
+        }
+    if "output_file" in args:
+        rc = write_output_file(merged, args)
+        if rc != 0:
+            return rc
+    else:
+        print_result(merged, args)
+    return 0 if all(ok for (ok, _) in results.values()) else 255
+
+
+def get_paging_parameters(aspec):
+    # Operations that page by offset, e.g. with $skip and $top
+    parameters = {}
+    for parameter in aspec.get("parameters", []):
+        if parameter.get("in") != "query":
+            continue
+        name = parameter["name"].lower()
+        if name in OFFSETPARAMETERS:
+            parameters["offset"] = parameter["name"].replace("-", "_")
+        elif name in LIMITPARAMETERS:
+            parameters["limit"] = parameter["name"].replace("-", "_")
+    if len(parameters) < 2:
+        return None
+    return parameters
+
+
+def get_total(responsecontent):
+    if isinstance(responsecontent, dict):
+        for key, value in responsecontent.items():
+            if key.lower() in TOTALKEYS and isinstance(value, int):
+                return value
+    return None
+
+
+def fetch_page(aspec, config, args, parameters, offset, limit):
+    pageargs = argparse.Namespace(**vars(args))
+    setattr(pageargs, parameters["offset"], offset)
+    setattr(pageargs, parameters["limit"], limit)
+    response = send_request(build_request(aspec, config, pageargs), args)
+    response.raise_for_status()
+    return jsoncodec.loads(response.content)
+
+
+def fetch_pages(aspec, config, args, parameters):
+    """Yield the content of all pages, in order
+
+    Once the first page tells the total, the other pages are requested
+    concurrently, up to PAGEWINDOW pages ahead of the page yielded next.
+    """
+    offset = getattr(args, parameters["offset"], None) or 0
+    limit = getattr(args, parameters["limit"], None)
+    firstpage = fetch_page(aspec, config, args, parameters, offset, limit)
+    yield firstpage
+    total = get_total(firstpage)
+    rows = tryconvert_result_to_list(firstpage)
+    if total is None or not isinstance(rows, list) or len(rows) == 0:
+        return
+    # The server may return fewer rows than asked for
+    pagesize = len(rows)
+    offsets = iter(range(offset + pagesize, total, pagesize))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=PAGEWINDOW) as executor:
+        window = collections.deque(
+            executor.submit(fetch_page, aspec, config, args, parameters, o, pagesize)
+            for o in itertools.islice(offsets, PAGEWINDOW)
+        )
+        while window:
+            page = window.popleft().result()
+            for nextoffset in itertools.islice(offsets, 1):
+                window.append(
+                    executor.submit(
+                        fetch_page,
+                        aspec,
+                        config,
+                        args,
+                        parameters,
+                        nextoffset,
+                        pagesize,
+                    )
+                )
+            yield page
+
+
+def is_streamable(args, cliquery):
+    # Table and csv output take rows as they arrive. Queries, and other formats,
+    # need the complete result.
+    if cliquery is not None:
+        return False
+    if "output_file" in args:
+        return args.output_as == "csv" and not columnar.is_columnar_path(
+            args.output_file
+        )
+    return args.output_as in ("table", "csv")
+
+
+def generate_page_rows(rows, pages):
+    yield from rows
+    for page in pages:
+        pagerows = tryconvert_result_to_list(page)
+        if isinstance(pagerows, list):
+            yield from pagerows
+
+
+def all_pages_command(aspec, config, args, cliquery):
+    pages = fetch_pages(aspec, config, args, get_paging_parameters(aspec))
+    try:
+        responsecontent = next(pages)
+        rows = tryconvert_result_to_list(responsecontent)
+        if isinstance(rows, list) and is_streamable(args, cliquery):
+            # Rows get formatted as soon as their page and all before it arrived
+            rowschema = columnar.get_row_schema(get_response_schema(aspec))
+            rows = generate_page_rows(rows, pages)
+            if "output_file" in args:
+                return write_output_chunks(
+                    args, generate_csv_chunks(rows, args.columns, rowschema)
+                )
+            if args.output_as == "csv":
+                for chunk in generate_csv_chunks(rows, args.columns, rowschema):
+                    console.print(chunk, end="")
+            else:
+                print_renderables(
+                    generate_table_rows(rows, args.columns, rowschema),
+                    "pager" in args and args.pager,
+                )
+            return 0
+        # Rows of later pages get appended to the first page's list
+        for page in pages:
+            pagerows = tryconvert_result_to_list(page)
+            if isinstance(rows, list) and isinstance(pagerows, list):
+                rows.extend(pagerows)
+    except (requests.RequestException, json.decoder.JSONDecodeError) as exc:
+        log.error(f"Failed to fetch pages - {exc}")
+        return 255
+    if cliquery is not None:
+        responsecontent = cliquery.search(responsecontent)
+    return output_result(responsecontent, aspec, args, cliquery)
+
+
+def get_job(request, response):
+    # Asynchronous operations answer with 202 Accepted, and the job's location
+    location = response.headers.get("Location")
+    if response.status_code != 202 or not location:
+        return None
+    return {
+        "url": urllib.parse.urljoin(response.url, location),
+        "headers": {
+            key: value
+            for (key, value) in request["headers"].items()
+            if key.lower() != "content-type"
+        },
+    }
+
+
+def is_job_running(response):
+    if response.status_code == 202:
+        return True
+    if not response.ok:
+        return False
+    try:
+        content = jsoncodec.loads(response.content)
+    except ValueError:
+        return False
+    if isinstance(content, dict):
+        for key in STATEKEYS:
+            state = str(content.get(key, "")).replace(" ", "").lower()
+            if state in RUNNINGSTATES:
+                return True
+    return False
+
+
+def poll_job(job, args):
+    request = {
+        "method": "GET",
+        "url": job["url"],
+        "params": {},
+        "headers": job["headers"],
+        "json": None,
+        "files": {},
+    }
+    response = send_request(request, args)
+    if response.status_code == 202 and response.headers.get("Location"):
+        # Jobs may move on to another location
+        job["url"] = urllib.parse.urljoin(response.url, response.headers["Location"])
+    return response
+
+
+def get_poll_interval(response, interval):
+    retryafter = response.headers.get("Retry-After", "") if response else ""
+    if retryafter.isdigit():
+        return float(retryafter)
+    return min(interval * 1.5, WAITMAXINTERVAL)
+
+
+def wait_for_jobs(jobs, args):
+    """Poll jobs concurrently, and yield (key, response) as each finishes
+
+    The response is None for jobs that didn't finish within args.wait seconds.
+    Polls are spread over a few threads, so that many jobs can be waited for.
+    """
+    deadline = time.monotonic() + args.wait
+    intervals = {key: WAITINTERVAL for key in jobs}
+    # (due, sequence, key) - the sequence keeps keys from being compared
+    sequence = itertools.count()
+    due = [(time.monotonic() + WAITINTERVAL, next(sequence), key) for key in jobs]
+    heapq.heapify(due)
+    pending = {}
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=transport.POOLSIZE
+    ) as executor:
+        while due or pending:
+            now = time.monotonic()
+            while due and due[0][0] <= now:
+                key = heapq.heappop(due)[2]
+                pending[executor.submit(poll_job, jobs[key], args)] = key
+            timeout = max(0, due[0][0] - now) if due else None
+            if not pending:
+                time.sleep(timeout)
+                continue
+            done, _ = concurrent.futures.wait(
+                pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    response = future.result()
+                except requests.RequestException as exc:
+                    log.warning(f"Polling {jobs[key]['url']} failed - {exc}")
+                    response = None
+                if response is not None and not is_job_running(response):
+                    yield key, response
+                    continue
+                intervals[key] = get_poll_interval(response, intervals[key])
+                if time.monotonic() + intervals[key] > deadline:
+                    yield key, None
+                    continue
+                heapq.heappush(
+                    due, (time.monotonic() + intervals[key], next(sequence), key)
+                )
+
+
+# Keys that identify list entries, so that changes in lists are matched by entry
+IDENTITYKEYS = ("id", "Id", "ID", "uid", "Uid", "RecordId", "name", "Name")
+
+
+def get_identity_key(old, new):
+    for key in IDENTITYKEYS:
+        values = [entry.get(key) if isinstance(entry, dict) else None for entry in old]
+        newvalues = [
+            entry.get(key) if isinstance(entry, dict) else None for entry in new
+        ]
+        if (
+            None not in values
+            and None not in newvalues
+            and len(set(map(str, values))) == len(values)
+            and len(set(map(str, newvalues))) == len(newvalues)
+        ):
+            return key
+    return None
+
+
+def diff_results(old, new, path=""):
+    """Return the changes from old to new as (change, path, old, new) tuples"""
+    changes = []
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key, value in old.items():
+            keypath = f"{path}.{key}" if path else str(key)
+            if key not in new:
+                changes.append(("-", keypath, value, None))
+            else:
+                changes += diff_results(value, new[key], keypath)
+        for key, value in new.items():
+            if key not in old:
+                keypath = f"{path}.{key}" if path else str(key)
+                changes.append(("+", keypath, None, value))
+    elif isinstance(old, list) and isinstance(new, list):
+        key = get_identity_key(old, new) if old and new else None
+        if key is None:
+            for index in range(max(len(old), len(new))):
+                indexpath = f"{path}[{index}]"
+                if index >= len(new):
+                    changes.append(("-", indexpath, old[index], None))
+                elif index >= len(old):
+                    changes.append(("+", indexpath, None, new[index]))
+                else:
+                    changes += diff_results(old[index], new[index], indexpath)
+        else:
+            oldentries = {str(entry[key]): entry for entry in old}
+            newentries = {str(entry[key]): entry for entry in new}
+            for identity, entry in oldentries.items():
+                entrypath = f"{path}[{key}={identity}]"
+                if identity not in newentries:
+                    changes.append(("-", entrypath, entry, None))
+                else:
+                    changes += diff_results(entry, newentries[identity], entrypath)
+            for identity, entry in newentries.items():
+                if identity not in oldentries:
+                    changes.append(("+", f"{path}[{key}={identity}]", None, entry))
+    elif old != new:
+        changes.append(("~", path, old, new))
+    return changes
+
+
+def print_changes(changes):
+    timestamp = time.strftime("%X")
+    for change, path, old, new in changes:
+        if change == "+":
+            console.print(
+                f"[{timestamp}] + {path}: {jsoncodec.dumps(new)}",
+                style="green",
+                markup=False,
+            )
+        elif change == "-":
+            console.print(
+                f"[{timestamp}] - {path}: {jsoncodec.dumps(old)}",
+                style="red",
+                markup=False,
+            )
+        else:
+            console.print(
+                f"[{timestamp}] ~ {path}: {jsoncodec.dumps(old)} -> {jsoncodec.dumps(new)}",
+                style="yellow",
+                markup=False,
+            )
+
+
+def watch_command(aspec, config, args, cliquery):
+    # Keeps polling on the shared session. ETags and Last-Modified are sent back,
+    # so that servers supporting conditional requests can skip unchanged bodies.
+    previous = None
+    validators = {}
+    while True:
+        started = time.monotonic()
+        try:
+            request = build_request(aspec, config, args)
+            request["headers"].update(validators)
+            response = send_request(request, args)
+            if response.status_code == 304:
+                log.debug("Not modified")
+            elif response.ok:
+                validators = {}
+                if "ETag" in response.headers:
+                    validators["If-None-Match"] = response.headers["ETag"]
+                if "Last-Modified" in response.headers:
+                    validators["If-Modified-Since"] = response.headers["Last-Modified"]
+                responsecontent = get_response_content(response, cliquery)
+                if previous is None:
+                    print_result(responsecontent, args)
+                else:
+                    print_changes(diff_results(previous, responsecontent))
+                previous = responsecontent
+        except json.decoder.JSONDecodeError:
+            log.error(f"Unexpected response - {response.text}")
+        except requests.RequestException as exc:
+            log.error(f"Request failed - {exc}")
+        time.sleep(max(0, args.watch - (time.monotonic() - started)))
+
+
+def get_follow_parameters(aspec):
+    # Operations can be followed when they page with a continuation token and
+    # accept a start time, like systemlog's GetRecords
+    parameters = {}
+    for parameter in aspec.get("parameters", []):
+        if parameter.get("in") != "query":
+            continue
+        name = parameter["name"].lower()
+        if name == "continuationtoken":
+            parameters["continuationtoken"] = parameter["name"].replace("-", "_")
+        elif name in ("startdatetime", "starttime", "from"):
+            parameters["start"] = parameter["name"].replace("-", "_")
+    if len(parameters) < 2:
+        return None
+    return parameters
+
+
+def get_checkpoint_path(config, args):
+    name = f"{config['customerid']}_{get_command_key(args)}_{args.subcommand}"
+    return os.path.join(CHECKPOINTPATH, re.sub("[^a-zA-Z0-9_.-]", "_", name) + ".json")
+
+
+def read_checkpoint(path):
+    try:
+        return jsoncodec.load_file(path)
+    except FileNotFoundError:
+        return {"timestamp": None, "recordids": [], "untimedids": []}
+
+
+def write_checkpoint(path, checkpoint):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    jsoncodec.dump_file(checkpoint, path)
+
+
+EARLIEST = datetime.datetime.min.replace(tzinfo=datetime.timezone.utc)
+
+
+def parse_timestamp(value):
+    # Compared as datetimes, as e.g. "...:30Z" is earlier than "...:30.5Z"
+    match = TIMESTAMPPATTERN.match(str(value)) if value is not None else None
+    if match is None:
+        return None
+    date, time_, fraction, zone = match.groups()
+    timestamp = datetime.datetime.strptime(f"{date}T{time_}", "%Y-%m-%dT%H:%M:%S")
+    timestamp = timestamp.replace(microsecond=int((fraction or "0")[:6].ljust(6, "0")))
+    offset = datetime.timedelta()
+    if zone and zone.upper() != "Z":
+        zone = zone.replace(":", "")
+        offset = datetime.timedelta(hours=int(zone[1:3]), minutes=int(zone[3:5]))
+        if zone[0] == "-":
+            offset = -offset
+    # Timestamps without a zone are taken as UTC
+    return timestamp.replace(tzinfo=datetime.timezone(offset))
+
+
+def get_record_timestamp_value(record):
+    for key in TIMESTAMPKEYS:
+        if key in record:
+            return record[key]
+    return None
+
+
+def get_record_timestamp(record):
+    return parse_timestamp(get_record_timestamp_value(record))
+
+
+def get_record_id(record):
+    for key in IDENTITYKEYS:
+        if key in record:
+            return str(record[key])
+    return json.dumps(record, sort_keys=True)
+
+
+def get_continuation_token(responsecontent):
+    if isinstance(responsecontent, dict):
+        for key, value in responsecontent.items():
+            if key.lower() == "continuationtoken":
+                return value
+    return None
+
+
+def get_next_checkpoint(checkpoint, records, untimedids=None):
+    # Remember the newest timestamp, and the records seen with it. Records
+    # without a timestamp are remembered by their id, for as long as the server
+    # keeps returning them: untimedids from fetch_new_records.
+    if untimedids is None:
+        untimedids = checkpoint.get("untimedids", []) + [
+            get_record_id(record)
+            for record in records
+            if get_record_timestamp(record) is None
+        ]
+    timedrecords = [
+        record for record in records if get_record_timestamp(record) is not None
+    ]
+    if len(timedrecords) == 0:
+        return dict(checkpoint, untimedids=untimedids)
+    newest = max(timedrecords, key=get_record_timestamp)
+    timestamp = get_record_timestamp(newest)
+    recordids = [
+        get_record_id(record)
+        for record in timedrecords
+        if get_record_timestamp(record) == timestamp
+    ]
+    if timestamp == parse_timestamp(checkpoint["timestamp"]):
+        recordids += checkpoint["recordids"]
+    return {
+        # As the server formatted it, to pass it back as the start time
+        "timestamp": get_record_timestamp_value(newest),
+        "recordids": recordids,
+        "untimedids": untimedids,
+    }
+
+
+def fetch_new_records(aspec, config, args, parameters, checkpoint):
+    """Return the new records, and the ids of all records without a timestamp
+
+    Records are fetched from the checkpoint's timestamp onwards. Records sharing
+    the checkpoint's timestamp may have been printed already, so skip those.
+    Records without a timestamp that aren't returned anymore won't be returned
+    for later timestamps either, so only the returned ones need remembering.
+    """
+    followargs = argparse.Namespace(**vars(args))
+    setattr(followargs, parameters["start"], checkpoint["timestamp"])
+    setattr(followargs, parameters["continuationtoken"], None)
+    since = parse_timestamp(checkpoint["timestamp"])
+    seen = set(checkpoint["recordids"])
+    untimedseen = set(checkpoint.get("untimedids", []))
+    untimedids = {}
+    records = []
+    while True:
+        response = send_request(build_request(aspec, config, followargs), args)
+        response.raise_for_status()
+        responsecontent = jsoncodec.loads(response.content)
+        for record in tryconvert_result_to_list(responsecontent) or []:
+            timestamp = get_record_timestamp(record)
+            if timestamp is None:
+                untimedids[get_record_id(record)] = None
+                if get_record_id(record) in untimedseen:
+                    continue
+            elif since is not None and (
+                timestamp < since
+                or (timestamp == since and get_record_id(record) in seen)
+            ):
+                continue
+            records.append(record)
+        continuationtoken = get_continuation_token(responsecontent)
+        if not continuationtoken:
+            break
+        setattr(followargs, parameters["continuationtoken"], continuationtoken)
+    # Print the oldest records first, and those without a timestamp before them
+    records.sort(key=lambda record: get_record_timestamp(record) or EARLIEST)
+    return (records, list(untimedids))
+
+
+def follow_command(aspec, config, args):
+    parameters = get_follow_parameters(aspec)
+    checkpointpath = get_checkpoint_path(config, args)
+    checkpoint = read_checkpoint(checkpointpath)
+    while True:
+        started = time.monotonic()
+        try:
+            records, untimedids = fetch_new_records(
+                aspec, config, args, parameters, checkpoint
+            )
+        except (requests.RequestException, json.decoder.JSONDecodeError) as exc:
+            log.error(f"Failed to fetch records - {exc}")
+            if args.follow == 0:
+                return 255
+            records = []
+        if len(records) > 0:
+            for record in records:
+                sys.stdout.write(jsoncodec.dumps(record) + "\n")
+            sys.stdout.flush()
+            # Only checkpoint once the records have been printed
+            checkpoint = get_next_checkpoint(checkpoint, records, untimedids)
+            write_checkpoint(checkpointpath, checkpoint)
+        if args.follow == 0:
+            return 0
+        time.sleep(max(0, args.follow - (time.monotonic() - started)))
+
+
+def bench_request(request, args):
+    # Not via send_request, which would coalesce the identical requests
+    with metrics.operation(f"{get_command_key(args)} {args.subcommand}"):
+        started = time.perf_counter()
+        try:
+            response = transport.get_session().request(**request)
+        except requests.RequestException as exc:
+            log.debug(f"Request failed - {exc}")
+            return (time.perf_counter() - started, None, 0, 0)
+        retries = 0
+        if getattr(response.raw, "retries", None) is not None:
+            retries = len(response.raw.retries.history)
+        return (
+            time.perf_counter() - started,
+            response.status_code,
+            len(response.content),
+            retries,
+        )
+
+
+def get_percentile(values, percentile):
+    # Nearest-rank percentile of the sorted values
+    return values[max(0, math.ceil(percentile / 100 * len(values)) - 1)]
+
+
+def bench_command(alloperations, config, args, benchargs):
+    if benchargs.requests < 1 or benchargs.concurrency < 1:
+        log.error("--requests and --concurrency must be at least 1")
+        return 2
+    aspec = get_operation_spec(alloperations, args)
+    # Assembled once, so that only the requests themselves get measured
+    request = build_request(aspec, config, args)
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=benchargs.concurrency
+    ) as executor:
+        results = list(
+            executor.map(
+                lambda _: bench_request(request, args), range(benchargs.requests)
+            )
+        )
+    duration = time.perf_counter() - started
+    latencies = sorted(result[0] for result in results)
+    statuses = [result[1] for result in results]
+    table = Table(show_header=True, header_style="bold magenta")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+    table.add_row("Requests", str(len(results)))
+    table.add_row("Concurrency", str(benchargs.concurrency))
+    table.add_row("Duration", f"{duration:.2f} s")
+    table.add_row("Throughput", f"{len(results) / duration:.1f} req/s")
+    for percentile in (50, 95, 99):
+        latency = get_percentile(latencies, percentile) * 1000
+        table.add_row(f"Latency p{percentile}", f"{latency:.1f} ms")
+    table.add_row(
+        "Errors",
+        str(sum(1 for status in statuses if status is None or status >= 400)),
+    )
+    table.add_row("Throttled (429)", str(statuses.count(429)))
+    table.add_row("Retries", str(sum(result[3] for result in results)))
+    table.add_row("Bytes received", str(sum(result[2] for result in results)))
+    console.print(table)
+    return 0 if all(status is not None and status < 400 for status in statuses) else 255
+
+
+def get_page_records(responsecontent):
+    rows = tryconvert_result_to_list(responsecontent)
+    return rows if isinstance(rows, list) else [responsecontent]
+
+
+def fetch_all_offset_records(aspec, config, args, parameters):
+    offset = getattr(args, parameters["offset"], None) or 0
+    limit = getattr(args, parameters["limit"], None)
+    pages = fetch_pages(aspec, config, args, parameters)
+    firstpage = next(pages)
+    records = get_page_records(firstpage)
+    for page in pages:
+        records += get_page_records(page)
+    if offset > 0:
+        # The records before the offset weren't fetched
+        return (records, False)
+    total = get_total(firstpage)
+    if total is not None:
+        return (records, len(records) >= total)
+    # Without a total, only a page shorter than asked for tells it was the last
+    return (records, limit is not None and len(records) < limit)
+
+
+def fetch_all_records(aspec, config, args):
+    """Return the records of all pages, and whether those are all the records
+
+    Follows offsets or continuation tokens, for operations that accept them.
+    """
+    parameters = get_paging_parameters(aspec)
+    if parameters is not None:
+        return fetch_all_offset_records(aspec, config, args, parameters)
+    continuationparameter = None
+    for parameter in aspec.get("parameters", []):
+        if parameter.get("in") == "query":
+            if parameter["name"].lower() == "continuationtoken":
+                continuationparameter = parameter["name"].replace("-", "_")
+    pageargs = argparse.Namespace(**vars(args))
+    records = []
+    while True:
+        response = send_request(build_request(aspec, config, pageargs), args)
+        response.raise_for_status()
+        responsecontent = jsoncodec.loads(response.content)
+        records += get_page_records(responsecontent)
+        continuationtoken = get_continuation_token(responsecontent)
+        if not continuationtoken:
+            return (records, True)
+        if continuationparameter is None:
+            # There are more records, but no way to ask for them
+            return (records, False)
+        setattr(pageargs, continuationparameter, continuationtoken)
+
+
+def sync_mirror(aspec, config, args, mirrorargs, db, table):
+    parameters = get_follow_parameters(aspec)
+    checkpoint = mirror.read_checkpoint(db, table)
+    untimedids = None
+    try:
+        if parameters is not None and checkpoint is not None:
+            # Only fetch the records added since the last sync
+            records, untimedids = fetch_new_records(
+                aspec, config, args, parameters, checkpoint
+            )
+            complete = False
+        else:
+            records, complete = fetch_all_records(aspec, config, args)
+    except (requests.RequestException, json.decoder.JSONDecodeError) as exc:
+        log.error(f"Failed to fetch records - {exc}")
+        return 255
+    records = [
+        record if isinstance(record, dict) else {"value": record} for record in records
+    ]
+    count = mirror.sync_records(
+        db,
+        table,
+        mirrorargs.index,
+        ((get_record_id(record), record) for record in records),
+        complete,
+    )
+    if parameters is not None and len(records) > 0:
+        mirror.write_checkpoint(
+            db,
+            table,
+            get_next_checkpoint(
+                checkpoint or {"timestamp": None, "recordids": [], "untimedids": []},
+                records,
+                untimedids,
+            ),
+        )
+    console.print(f"Mirrored {count} records into table {table}.")
+    return 0
+
+
+def query_mirror(db, table, args, mirrorargs, cliquery):
+    try:
+        if mirrorargs.sql:
+            result = mirror.query(db, mirrorargs.sql)
+        else:
+            result = mirror.read_records(db, table)
+    except sqlite3.Error as exc:
+        log.error(f"Querying the mirror failed - {exc}")
+        return 1
+    if cliquery is not None:
+        result = cliquery.search(result)
+    if "output_file" in args:
+        return write_output_file(result, args)
+    print_result(result, args)
+    return 0
+
+
+def mirror_command(alloperations, config, args, mirrorargs):
+    aspec = get_operation_spec(alloperations, args)
+    try:
+        cliquery = get_cliquery(args)
+    except jmespath.exceptions.ParseError as error:
+        log.error("Invalid cliquery syntax - " + str(error))
+        return 1
+    table = mirror.get_table_name(f"{get_command_key(args)}_{args.subcommand}")
+    db = mirror.connect(mirror.get_mirror_path(config["customerid"]))
+    try:
+        if mirrorargs.local or mirrorargs.sql:
+            return query_mirror(db, table, args, mirrorargs, cliquery)
+        return sync_mirror(aspec, config, args, mirrorargs, db, table)
+    finally:
+        db.close()
@@ -0,0 +1,190 @@
+import logging
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    # Columnar output is optional: pip install pyarrow
+    pyarrow = None
+
+from . import jsoncodec
+
+log = logging.getLogger()
+
+COLUMNAREXTENSIONS = (".parquet", ".arrow", ".feather")
+# Rows per row group (Parquet) or record batch (Arrow/Feather)
+BATCHSIZE = 65536
+
+
+def get_wider_types():
+    # What a column gets widened to, when a value doesn't fit its type
+    return {
+        pyarrow.int64(): pyarrow.float64(),
+        pyarrow.float64(): pyarrow.string(),
+        pyarrow.bool_(): pyarrow.string(),
+    }
+
+
+def is_columnar_path(path):
+    return path.lower().endswith(COLUMNAREXTENSIONS)
+
+
+def get_row_schema(schema):
+    # Mirrors clidriver.tryconvert_result_to_list to find the schema of a row
+    if not isinstance(schema, dict):
+        return None
+    if schema.get("type") == "array":
+        schema = schema.get("items", {})
+    elif "properties" in schema:
+        properties = schema["properties"]
+        if len(properties) == 1:
+            schema = next(iter(properties.values()))
+        elif "items" in properties:
+            schema = properties["items"]
+        elif "Items" in properties:
+            schema = properties["Items"]
+        else:
+            return None
+        if isinstance(schema, dict) and schema.get("type") == "array":
+            schema = schema.get("items", {})
+    if not isinstance(schema, dict) or "properties" not in schema:
+        return None
+    return schema["properties"]
+
+
+def get_arrow_type(propertyschema):
+    propertytype = (
+        propertyschema.get("type") if isinstance(propertyschema, dict) else None
+    )
+    if propertytype == "integer":
+        return pyarrow.int64()
+    elif propertytype == "number":
+        return pyarrow.float64()
+    elif propertytype == "boolean":
+        return pyarrow.bool_()
+    # Strings, as well as nested objects and arrays, which get stored as JSON
+    return pyarrow.string()
+
+
+def infer_arrow_type(values):
+    types = {type(value) for value in values if value is not None}
+    if types == {bool}:
+        return pyarrow.bool_()
+    elif types == {int}:
+        return pyarrow.int64()
+    elif types and types <= {int, float}:
+        return pyarrow.float64()
+    return pyarrow.string()
+
+
+def get_arrow_schema(rows, rowschema):
+    # Columns declared in the response schema come first, in the spec's order.
+    # Keys that aren't declared get their type inferred from their values.
+    fields = {}
+    if rowschema is not None:
+        for column, propertyschema in rowschema.items():
+            fields[column] = get_arrow_type(propertyschema)
+    undeclared = {}
+    for row in rows:
+        for key in row:
+            if key not in fields:
+                undeclared.setdefault(key)
+    for column in undeclared:
+        fields[column] = infer_arrow_type(row.get(column) for row in rows)
+    for column, arrowtype in fields.items():
+        fields[column] = get_fitting_type(column, arrowtype, rows)
+    return pyarrow.schema(list(fields.items()))
+
+
+def get_fitting_type(column, arrowtype, rows):
+    # Values that don't fit the declared type widen the column, rather than
+    # getting truncated or lost
+    widertypes = get_wider_types()
+    while arrowtype in widertypes:
+        convert = get_converter(arrowtype)
+        try:
+            for row in rows:
+                convert(row.get(column))
+            break
+        except (TypeError, ValueError):
+            widertype = widertypes[arrowtype]
+            log.warning(
+                f"Storing column {column} as {widertype}, as {row.get(column)!r}"
+                f" doesn't fit {arrowtype}"
+            )
+            arrowtype = widertype
+    return arrowtype
+
+
+def get_converter(arrowtype):
+    # Converters are picked once per column. They raise ValueError for values
+    # that don't fit the type without loss.
+    def to_string(value):
+        if value is None or isinstance(value, str):
+            return value
+        return jsoncodec.dumps(value)
+
+    def to_int(value):
+        if value is None or type(value) is int:
+            return value
+        if isinstance(value, bool) or (
+            isinstance(value, float) and not value.is_integer()
+        ):
+            raise ValueError(value)
+        return int(value)
+
+    def to_float(value):
+        if value is None or type(value) is float:
+            return value
+        if isinstance(value, bool):
+            raise ValueError(value)
+        return float(value)
+
+    def to_bool(value):
+        if value is None or isinstance(value, bool):
+            return value
+        if str(value).lower() not in ("true", "false"):
+            raise ValueError(value)
+        return str(value).lower() == "true"
+
+    if arrowtype == pyarrow.int64():
+        return to_int
+    elif arrowtype == pyarrow.float64():
+        return to_float
+    elif arrowtype == pyarrow.bool_():
+        return to_bool
+    return to_string
+
+
+def to_record_batch(rows, schema, converters):
+    columns = []
+    for field, converter in zip(schema, converters):
+        columns.append(
+            pyarrow.array(
+                [converter(row.get(field.name)) for row in rows], type=field.type
+            )
+        )
+    return pyarrow.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def write_columnar(path, rows, rowschema=None):
+    """Write rows to a Parquet, Arrow or Feather file, in batches of BATCHSIZE"""
+    if pyarrow is None:
+        raise ImportError(f"Writing {path} requires pyarrow: pip install pyarrow")
+    rows = [row if isinstance(row, dict) else {"value": row} for row in rows]
+    schema = get_arrow_schema(rows, rowschema)
+    converters = [get_converter(field.type) for field in schema]
+    batches = (
+        to_record_batch(rows[start : start + BATCHSIZE], schema, converters)
+        for start in range(0, len(rows), BATCHSIZE)
+    )
+    if path.lower().endswith(".parquet"):
+        with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+            for batch in batches:
+                writer.write_table(pyarrow.Table.from_batches([batch]))
+    else:
+        # Feather V2 is the Arrow IPC file format
+        with pyarrow.ipc.new_file(path, schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
@@ -0,0 +1,47 @@
+import json
+import os
+
+try:
+    import orjson
+except ImportError:
+    # A fast native JSON library is optional: pip install orjson
+    orjson = None
+
+
+def loads(data):
+    """Decode JSON from str or bytes. Raises json.JSONDecodeError on failure."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumpb(obj, indent=False):
+    """Encode to UTF-8 JSON bytes, optionally indented by two spaces"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(
+                obj,
+                option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0),
+            )
+        except TypeError:
+            # e.g. integers beyond 64 bit, which only the stdlib handles
+            pass
+    return json.dumps(obj, indent=2 if indent else None, ensure_ascii=False).encode(
+        "utf-8"
+    )
+
+
+def dumps(obj, indent=False):
+    return dumpb(obj, indent).decode("utf-8")
+
+
+def load_file(path):
+    with open(path, "rb") as fp:
+        return loads(fp.read())
+
+
+def dump_file(obj, path, indent=False):
+    # Replace atomically, so that readers never see a partially written file
+    with open(path + ".tmp", "wb") as fp:
+        fp.write(dumpb(obj, indent))
+    os.replace(path + ".tmp", path)
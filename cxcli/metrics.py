@@ -0,0 +1,232 @@
+"""Opt-in request metrics, exported when the process exits
+
+Enable with --metrics-file or CXCLI_METRICS. The file's extension selects the
+format: '.prom' writes a Prometheus textfile (accumulated across invocations),
+anything else appends OpenTelemetry (OTLP/JSON) spans, one line per invocation.
+"""
+
+import atexit
+import contextlib
+import os
+import threading
+import time
+import urllib.parse
+
+from . import jsoncodec
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows - the state file is then updated without a lock
+    fcntl = None
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PATH = None
+LOCK = threading.Lock()
+LOCAL = threading.local()
+COUNTERS = {}
+HISTOGRAMS = {}
+SPANS = []
+
+
+def configure(path):
+    global PATH
+    if path and PATH is None:
+        PATH = path
+        atexit.register(export)
+
+
+def is_enabled():
+    return PATH is not None
+
+
+@contextlib.contextmanager
+def operation(name):
+    # Requests sent within this context are attributed to the operation
+    previous = getattr(LOCAL, "operation", None)
+    LOCAL.operation = name
+    try:
+        yield
+    finally:
+        LOCAL.operation = previous
+
+
+def get_operation():
+    return getattr(LOCAL, "operation", None) or "other"
+
+
+def count(name, labels=(), value=1):
+    if PATH is None:
+        return
+    key = (name, tuple(labels))
+    with LOCK:
+        COUNTERS[key] = COUNTERS.get(key, 0) + value
+
+
+def observe(name, labels, seconds):
+    if PATH is None:
+        return
+    key = (name, tuple(labels))
+    with LOCK:
+        histogram = HISTOGRAMS.setdefault(key, [0] * len(BUCKETS) + [0, 0.0])
+        for index, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram[index] += 1
+        # The last two entries are the count and the sum
+        histogram[-2] += 1
+        histogram[-1] += seconds
+
+
+def record_response(response, *args, **kwargs):
+    """Response hook for the shared session"""
+    if PATH is None:
+        return
+    operationname = get_operation()
+    seconds = response.elapsed.total_seconds()
+    retries = 0
+    if getattr(response.raw, "retries", None) is not None:
+        retries = len(response.raw.retries.history)
+    size = len(response.content)
+    method = response.request.method
+    labels = (("operation", operationname),)
+    count(
+        "cxcli_requests_total",
+        labels + (("method", method), ("status", str(response.status_code))),
+    )
+    observe("cxcli_request_duration_seconds", labels, seconds)
+    count("cxcli_response_bytes_total", labels, size)
+    if retries:
+        count("cxcli_retries_total", labels, retries)
+    if not PATH.endswith(".prom"):
+        end = int(time.time() * 1e9)
+        span = {
+            "traceId": os.urandom(16).hex(),
+            "spanId": os.urandom(8).hex(),
+            "name": operationname,
+            "kind": 3,
+            "startTimeUnixNano": str(end - int(seconds * 1e9)),
+            "endTimeUnixNano": str(end),
+            "attributes": [
+                {"key": "http.method", "value": {"stringValue": method}},
+                {"key": "http.url", "value": {"stringValue": get_url(response)}},
+                {
+                    "key": "http.status_code",
+                    "value": {"intValue": str(response.status_code)},
+                },
+                {
+                    "key": "http.response_content_length",
+                    "value": {"intValue": str(size)},
+                },
+                {"key": "cxcli.retries", "value": {"intValue": str(retries)}},
+            ],
+            "status": {"code": 2 if response.status_code >= 400 else 1},
+        }
+        with LOCK:
+            SPANS.append(span)
+
+
+def get_url(response):
+    # Leave out the query, which may contain customer data
+    url = urllib.parse.urlsplit(response.url)
+    return urllib.parse.urlunsplit((url.scheme, url.netloc, url.path, "", ""))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for (key, value) in labels) + "}"
+
+
+def format_prometheus(counters, histograms):
+    lines = []
+    for name in sorted({name for (name, _) in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (countername, labels), value in sorted(counters.items()):
+            if countername == name:
+                lines.append(f"{name}{format_labels(labels)} {value}")
+    for name in sorted({name for (name, _) in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (histogramname, labels), histogram in sorted(histograms.items()):
+            if histogramname != name:
+                continue
+            for bound, value in zip(
+                BUCKETS + ("+Inf",), histogram[:-2] + [histogram[-2]]
+            ):
+                bucketlabels = format_labels(labels + (("le", str(bound)),))
+                lines.append(f"{name}_bucket{bucketlabels} {value}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram[-1]}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram[-2]}")
+    return "\n".join(lines) + "\n"
+
+
+def merge_state(state, counters, histograms):
+    # The state is kept as lists, as JSON has no tuple keys
+    merged_counters = {
+        (name, tuple(map(tuple, labels))): value
+        for (name, labels, value) in state.get("counters", [])
+    }
+    for key, value in counters.items():
+        merged_counters[key] = merged_counters.get(key, 0) + value
+    merged_histograms = {
+        (name, tuple(map(tuple, labels))): histogram
+        for (name, labels, histogram) in state.get("histograms", [])
+    }
+    for key, histogram in histograms.items():
+        previous = merged_histograms.get(key, [0] * len(histogram))
+        merged_histograms[key] = [a + b for (a, b) in zip(previous, histogram)]
+    return merged_counters, merged_histograms
+
+
+def export_prometheus(path, counters, histograms):
+    # Counters accumulate across invocations in a state file next to the textfile
+    with open(path + ".lock", "a") as lockfile:
+        if fcntl is not None:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            state = jsoncodec.load_file(path + ".state")
+        except (FileNotFoundError, ValueError):
+            state = {}
+        counters, histograms = merge_state(state, counters, histograms)
+        jsoncodec.dump_file(
+            {
+                "counters": [[n, l, v] for ((n, l), v) in counters.items()],
+                "histograms": [[n, l, h] for ((n, l), h) in histograms.items()],
+            },
+            path + ".state",
+        )
+        # The textfile collector must never see a partially written file
+        with open(path + ".tmp", "w") as fp:
+            fp.write(format_prometheus(counters, histograms))
+        os.replace(path + ".tmp", path)
+
+
+def export_spans(path, spans):
+    resourcespans = {
+        "resourceSpans": [
+            {
+                "resource": {
+                    "attributes": [
+                        {"key": "service.name", "value": {"stringValue": "cxcli"}}
+                    ]
+                },
+                "scopeSpans": [{"scope": {"name": "cxcli"}, "spans": spans}],
+            }
+        ]
+    }
+    with open(path, "ab") as fp:
+        fp.write(jsoncodec.dumpb(resourcespans) + b"\n")
+
+
+def export():
+    with LOCK:
+        counters = dict(COUNTERS)
+        histograms = {key: list(value) for (key, value) in HISTOGRAMS.items()}
+        spans = list(SPANS)
+    if not counters and not histograms:
+        return
+    if PATH.endswith(".prom"):
+        export_prometheus(PATH, counters, histograms)
+    elif spans:
+        export_spans(PATH, spans)
@@ -0,0 +1,130 @@
+"""Local SQLite mirrors of list operations, for repeated queries without downloads
+
+Every mirrored operation gets a table with the record's key, the record as JSON,
+and a column with an index for each field chosen via --index.
+"""
+
+import os
+import re
+import sqlite3
+import time
+
+from . import jsoncodec
+
+MIRRORPATH = os.path.join(os.path.expanduser("~"), ".cxcli", "mirrors")
+
+
+def get_mirror_path(customerid):
+    return os.path.join(MIRRORPATH, re.sub("[^a-zA-Z0-9_.-]", "_", customerid) + ".db")
+
+
+def get_table_name(name):
+    return re.sub("[^a-zA-Z0-9_]", "_", name)
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+def connect(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path)
+    # Queries can run while a sync is writing
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS _mirrors (name TEXT PRIMARY KEY, checkpoint TEXT)"
+    )
+    return db
+
+
+def get_fields(db, table):
+    columns = [row[1] for row in db.execute(f"PRAGMA table_info({quote(table)})")]
+    return [column for column in columns if not column.startswith("_")]
+
+
+def create_table(db, table, indexes):
+    db.execute(
+        f"CREATE TABLE IF NOT EXISTS {quote(table)}"
+        " (_key TEXT PRIMARY KEY, _data TEXT NOT NULL, _synced REAL NOT NULL)"
+    )
+    fields = get_fields(db, table)
+    for field in indexes:
+        if field not in fields:
+            db.execute(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(field)}")
+            # Existing rows get the new column from their JSON
+            db.execute(
+                f"UPDATE {quote(table)} SET {quote(field)} = json_extract(_data, ?)",
+                (f'$."{field}"',),
+            )
+            fields.append(field)
+        db.execute(
+            f"CREATE INDEX IF NOT EXISTS {quote(f'{table}_{field}')}"
+            f" ON {quote(table)} ({quote(field)})"
+        )
+    return fields
+
+
+def get_column_value(value):
+    # Nested objects and arrays are stored as JSON
+    if isinstance(value, (dict, list)):
+        return jsoncodec.dumps(value)
+    return value
+
+
+def upsert_records(db, table, fields, keyedrecords, synced):
+    columns = ["_key", "_data", "_synced"] + fields
+    statement = (
+        f"INSERT OR REPLACE INTO {quote(table)} ({', '.join(map(quote, columns))})"
+        f" VALUES ({', '.join('?' * len(columns))})"
+    )
+    db.executemany(
+        statement,
+        (
+            [key, jsoncodec.dumps(record), synced]
+            + [get_column_value(record.get(field)) for field in fields]
+            for (key, record) in keyedrecords
+        ),
+    )
+
+
+def sync_records(db, table, indexes, keyedrecords, complete):
+    """Store the records, and with complete=True remove all others
+
+    Returns the number of records stored.
+    """
+    synced = time.time()
+    keyedrecords = list(keyedrecords)
+    with db:
+        fields = create_table(db, table, indexes)
+        upsert_records(db, table, fields, keyedrecords, synced)
+        if complete:
+            db.execute(f"DELETE FROM {quote(table)} WHERE _synced < ?", (synced,))
+    return len(keyedrecords)
+
+
+def read_checkpoint(db, table):
+    row = db.execute(
+        "SELECT checkpoint FROM _mirrors WHERE name = ?", (table,)
+    ).fetchone()
+    return jsoncodec.loads(row[0]) if row else None
+
+
+def write_checkpoint(db, table, checkpoint):
+    with db:
+        db.execute(
+            "INSERT OR REPLACE INTO _mirrors (name, checkpoint) VALUES (?, ?)",
+            (table, jsoncodec.dumps(checkpoint)),
+        )
+
+
+def read_records(db, table):
+    return [
+        jsoncodec.loads(row[0])
+        for row in db.execute(f"SELECT _data FROM {quote(table)} ORDER BY rowid")
+    ]
+
+
+def query(db, sql):
+    cursor = db.execute(sql)
+    columns = [description[0] for description in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
@@ -0,0 +1,182 @@
+"""Local stand-in for Citrix Cloud, replaying cassettes recorded with CXCLI_RECORD
+
+Usage:
+    CXCLI_RECORD=cassette.jsonl cx systemlog GetRecords
+    python -m cxcli.mockserver cassette.jsonl --port 8080 --latency 0.05
+    CXCLI_ENDPOINT=http://127.0.0.1:8080 cx systemlog GetRecords
+"""
+
+import argparse
+import http.server
+import itertools
+import json
+import random
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from . import transport
+
+# Response headers that no longer apply once the body has been replayed
+SKIPHEADERS = ("content-length", "content-encoding", "transfer-encoding", "connection")
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+def get_interaction_key(method, host, path):
+    return (method.upper(), host.lower(), path)
+
+
+def resize_payload(body, items):
+    # Repeat the entries of list responses, to simulate larger tenants
+    try:
+        content = json.loads(body)
+    except ValueError:
+        return body
+    rows = content
+    if isinstance(content, dict):
+        for key in ("items", "Items"):
+            if isinstance(content.get(key), list):
+                rows = content[key]
+        if len(content) == 1 and isinstance(next(iter(content.values())), list):
+            rows = next(iter(content.values()))
+    if not isinstance(rows, list) or len(rows) == 0:
+        return body
+    rows[:] = list(itertools.islice(itertools.cycle(list(rows)), items))
+    return json.dumps(content).encode("utf-8")
+
+
+class MockServer:
+    def __init__(
+        self, interactions, latency=0, throttlerate=0, payloaditems=None, seed=0
+    ):
+        # Responses for the same request get replayed in the recorded order, so
+        # that e.g. pagination works
+        self.responses = {}
+        for interaction in interactions:
+            url = urllib.parse.urlsplit(interaction["request"]["url"])
+            host = interaction["request"]["headers"].get(
+                transport.ORIGINALHOSTHEADER, url.netloc
+            )
+            key = get_interaction_key(interaction["request"]["method"], host, url.path)
+            self.responses.setdefault(key, {}).setdefault(url.query, []).append(
+                interaction["response"]
+            )
+        self.counters = {}
+        self.latency = latency
+        self.throttlerate = throttlerate
+        self.payloaditems = payloaditems
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def get_response(self, method, host, path, query):
+        byquery = self.responses.get(get_interaction_key(method, host, path))
+        if byquery is None:
+            return None
+        # Prefer responses recorded for the same query
+        if query not in byquery:
+            query = next(iter(byquery))
+        responses = byquery[query]
+        with self.lock:
+            counter = self.counters.get((method, host, path, query), 0)
+            self.counters[(method, host, path, query)] = counter + 1
+            throttle = self.random.random() < self.throttlerate
+        if throttle:
+            return {
+                "status": 429,
+                "headers": {"Retry-After": "1", "Content-Type": "application/json"},
+                "body": '{"error": "Too Many Requests"}',
+                "encoding": "text",
+            }
+        return responses[counter % len(responses)]
+
+    def get_handler(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def handle_request(self):
+                length = int(self.headers.get("Content-Length", 0))
+                if length:
+                    self.rfile.read(length)
+                url = urllib.parse.urlsplit(self.path)
+                host = self.headers.get(transport.ORIGINALHOSTHEADER, "")
+                if server.latency:
+                    time.sleep(server.latency)
+                response = server.get_response(self.command, host, url.path, url.query)
+                if response is None:
+                    response = {
+                        "status": 404,
+                        "headers": {"Content-Type": "application/json"},
+                        "body": '{"error": "No recorded interaction"}',
+                        "encoding": "text",
+                    }
+                body = transport.decode_body(response["body"], response["encoding"])
+                if server.payloaditems and response["status"] == 200:
+                    body = resize_payload(body, server.payloaditems)
+                self.send_response(response["status"])
+                for key, value in response["headers"].items():
+                    if key.lower() not in SKIPHEADERS:
+                        self.send_header(key, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+            do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = handle_request
+
+        return Handler
+
+    def create_server(self, host="127.0.0.1", port=8080):
+        return ThreadingHTTPServer((host, port), self.get_handler())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded Citrix Cloud interactions for offline testing"
+    )
+    parser.add_argument(
+        "cassette", nargs="+", help="Cassettes recorded via CXCLI_RECORD"
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument(
+        "--latency", type=float, default=0, help="Seconds to delay every response"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0,
+        help="Share of requests to answer with 429 Too Many Requests",
+    )
+    parser.add_argument(
+        "--payload-items",
+        type=int,
+        help="Resize list responses to this many entries",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for throttling")
+    args = parser.parse_args()
+    interactions = []
+    for cassette in args.cassette:
+        interactions += transport.read_cassette(cassette)
+    mockserver = MockServer(
+        interactions, args.latency, args.throttle_rate, args.payload_items, args.seed
+    )
+    httpd = mockserver.create_server(args.host, args.port)
+    print(f"Serving {len(interactions)} interactions on http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+import gzip
+import lzma
+import os
+import queue
+import threading
+
+try:
+    import zstandard
+except ImportError:
+    # Zstandard compression is optional: pip install zstandard
+    zstandard = None
+
+COMPRESSIONEXTENSIONS = (".gz", ".zst", ".xz")
+# Chunks buffered for the writer thread, before the formatter has to wait
+QUEUESIZE = 64
+
+
+def get_compression(path):
+    for extension in COMPRESSIONEXTENSIONS:
+        if path.lower().endswith(extension):
+            return extension
+    return None
+
+
+def open_compressed(path, compression):
+    if compression == ".gz":
+        return gzip.open(path, "wb")
+    elif compression == ".xz":
+        return lzma.open(path, "wb")
+    elif compression == ".zst":
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    return open(path, "wb")
+
+
+def write_chunks(path, chunks):
+    """Write byte chunks to path, compressed according to its extension
+
+    Compression and disk I/O happen in a background thread, while the caller
+    keeps producing chunks. The file only appears once it is complete.
+    """
+    compression = get_compression(path)
+    if compression == ".zst" and zstandard is None:
+        # Fail before producing any output
+        raise ImportError(f"Writing {path} requires zstandard: pip install zstandard")
+    chunkqueue = queue.Queue(maxsize=QUEUESIZE)
+    errors = []
+
+    def writer():
+        done = False
+        try:
+            with open_compressed(path + ".tmp", compression) as fp:
+                while not done:
+                    chunk = chunkqueue.get()
+                    done = chunk is None
+                    if not done:
+                        fp.write(chunk)
+        except Exception as exc:
+            errors.append(exc)
+            # Keep consuming, so that the producer never blocks
+            while not done:
+                done = chunkqueue.get() is None
+
+    thread = threading.Thread(target=writer, daemon=True)
+    thread.start()
+    completed = False
+    try:
+        for chunk in chunks:
+            if errors:
+                break
+            chunkqueue.put(chunk)
+        completed = not errors
+    finally:
+        chunkqueue.put(None)
+        thread.join()
+        if not completed or errors:
+            if os.path.exists(path + ".tmp"):
+                os.unlink(path + ".tmp")
+    if errors:
+        raise errors[0]
+    os.replace(path + ".tmp", path)
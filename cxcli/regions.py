@@ -0,0 +1,123 @@
+import concurrent.futures
+import logging
+import os
+import re
+import threading
+import time
+
+import requests
+
+from . import jsoncodec
+
+log = logging.getLogger()
+
+# Citrix Cloud regions - the API gateway host, and the region's name in the
+# releases API
+REGIONS = {
+    "us": {"api": "api-us.cloud.com", "releases": "EastUS"},
+    "eu": {"api": "api-eu.cloud.com", "releases": "WestEurope"},
+    "ap-s": {"api": "api-ap-s.cloud.com", "releases": "SouthEastAsia"},
+    "jp": {"api": "api.citrixcloud.jp", "releases": "JapanEast"},
+}
+DEFAULTREGION = "us"
+# Probe the regions, and use the one with the lowest latency
+AUTOREGION = "auto"
+# Spec hosts that are served by every region's API gateway
+APIHOSTPATTERN = re.compile(r"^api(-us|-eu|-ap-s)?\.cloud\.com$", re.IGNORECASE)
+
+# Where the region selected by probing is cached, per profile
+REGIONCACHEPATH = os.path.join(os.path.expanduser("~"), ".cxcli", "regions.json")
+SCHEME = "https"
+# Requests per region - the fastest one counts, as the first includes the
+# TLS handshake
+PROBECOUNT = 2
+PROBETIMEOUT = 5
+
+SELECTED = {}
+SELECTEDLOCK = threading.Lock()
+
+
+def probe_region(region):
+    url = f"{SCHEME}://{REGIONS[region]['api']}/"
+    latencies = []
+    # Not the shared session, whose hooks would count the probes as requests
+    with requests.Session() as session:
+        for _ in range(PROBECOUNT):
+            start = time.perf_counter()
+            try:
+                # Any response will do, only the round trip matters
+                session.head(url, timeout=PROBETIMEOUT)
+            except requests.exceptions.RequestException as exc:
+                log.debug(f"Probing {url} failed with: {exc}")
+                return None
+            latencies.append(time.perf_counter() - start)
+    return min(latencies)
+
+
+def probe_regions():
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(REGIONS)) as executor:
+        latencies = dict(zip(REGIONS, executor.map(probe_region, REGIONS)))
+    log.debug(f"Region latencies: {latencies}")
+    reachable = {
+        region: latency
+        for (region, latency) in latencies.items()
+        if latency is not None
+    }
+    if not reachable:
+        log.warning(f"No region reachable, using {DEFAULTREGION}")
+        return None
+    return min(reachable, key=reachable.get)
+
+
+def read_region_cache():
+    try:
+        return jsoncodec.load_file(REGIONCACHEPATH)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def reset_region_cache(profile):
+    cache = read_region_cache()
+    if profile in cache:
+        del cache[profile]
+        jsoncodec.dump_file(cache, REGIONCACHEPATH)
+    with SELECTEDLOCK:
+        SELECTED.pop(profile, None)
+
+
+def select_region(profile):
+    # Probing takes a while, so it's done once per profile and then cached
+    with SELECTEDLOCK:
+        if profile not in SELECTED:
+            cache = read_region_cache()
+            if cache.get(profile) in REGIONS:
+                SELECTED[profile] = cache[profile]
+            else:
+                region = probe_regions()
+                if region is not None:
+                    os.makedirs(os.path.dirname(REGIONCACHEPATH), exist_ok=True)
+                    cache[profile] = region
+                    jsoncodec.dump_file(cache, REGIONCACHEPATH)
+                SELECTED[profile] = region or DEFAULTREGION
+        return SELECTED[profile]
+
+
+def get_region(config):
+    region = config.get("region") or DEFAULTREGION
+    if region == AUTOREGION:
+        return select_region(config["profile"])
+    if region not in REGIONS:
+        log.warning(f"Unknown region {region}, using {DEFAULTREGION}")
+        return DEFAULTREGION
+    return region
+
+
+def get_api_host(config):
+    return REGIONS[get_region(config)]["api"]
+
+
+def rewrite_host(host, config):
+    # Send requests for the API gateway to the configured region
+    if APIHOSTPATTERN.match(host):
+        return get_api_host(config)
+    return host
@@ -0,0 +1,35 @@
+"""Share one in-flight call between concurrent callers with the same key"""
+
+import concurrent.futures
+import threading
+
+from . import metrics
+
+LOCK = threading.Lock()
+# key -> future of the call in flight
+CALLS = {}
+
+
+def do(key, function):
+    with LOCK:
+        future = CALLS.get(key)
+        leader = future is None
+        if leader:
+            future = CALLS[key] = concurrent.futures.Future()
+    if not leader:
+        metrics.count(
+            "cxcli_coalesced_calls_total", (("operation", metrics.get_operation()),)
+        )
+        return future.result()
+    try:
+        result = function()
+    except BaseException as exc:
+        future.set_exception(exc)
+        raise
+    else:
+        future.set_result(result)
+        return result
+    finally:
+        # Later callers make a call of their own
+        with LOCK:
+            del CALLS[key]
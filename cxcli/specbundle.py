@@ -0,0 +1,114 @@
+"""Single-file bundles of the synced specs, for images and read-only environments
+
+A bundle starts with MAGIC, the length of the index and the index itself. The
+index maps every service to its title and to the offset and length of its spec,
+relative to the end of the index, so that bundles can be copied anywhere. The
+file is memory-mapped, so processes only decode the specs they use and share
+the pages with each other.
+"""
+
+import mmap
+import os
+import struct
+
+from . import jsoncodec
+from . import syncspecs
+
+MAGIC = b"CXSPECS1"
+HEADER = struct.Struct(">8sQ")
+BUNDLES = {}
+
+
+class SpecBundleException(Exception):
+    pass
+
+
+def get_bundle_path():
+    return os.environ.get("CXCLI_SPEC_PATH") or None
+
+
+def export_bundle(path):
+    """Write the specs in APISPECPATH to a bundle at path
+
+    Returns the number of services in the bundle.
+    """
+    if not os.path.exists(syncspecs.SEARCHINDEXPATH):
+        syncspecs.build_metadata()
+    metacache = jsoncodec.load_file(syncspecs.METACACHEPATH)
+    services = {}
+    blobs = []
+    offset = 0
+    for filename in sorted(os.listdir(syncspecs.APISPECPATH)):
+        if not filename.endswith(".json"):
+            continue
+        name = filename.split(".", 1)[0]
+        # Re-encoded, as compact JSON
+        blob = jsoncodec.dumpb(
+            jsoncodec.load_file(os.path.join(syncspecs.APISPECPATH, filename))
+        )
+        services[name] = [metacache.get(name, ""), offset, len(blob)]
+        blobs.append(blob)
+        offset += len(blob)
+    with open(syncspecs.SEARCHINDEXPATH, "rb") as fp:
+        blob = fp.read()
+    index = jsoncodec.dumpb({"services": services, "searchindex": [offset, len(blob)]})
+    blobs.append(blob)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if os.path.exists(path + ".tmp"):
+        # Left over from an interrupted export, and read-only
+        os.unlink(path + ".tmp")
+    with open(path + ".tmp", "wb") as fp:
+        fp.write(HEADER.pack(MAGIC, len(index)))
+        fp.write(index)
+        for blob in blobs:
+            fp.write(blob)
+    # Bundles are meant to be shared, not modified in place
+    os.chmod(path + ".tmp", 0o444)
+    os.replace(path + ".tmp", path)
+    return len(services)
+
+
+def open_bundle(path):
+    if path in BUNDLES:
+        return BUNDLES[path]
+    try:
+        with open(path, "rb") as fp:
+            try:
+                data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                # e.g. empty files or file systems without mmap support
+                data = fp.read()
+    except OSError as exc:
+        raise SpecBundleException(f"Can't open spec bundle {path}: {exc}")
+    if len(data) < HEADER.size:
+        raise SpecBundleException(f"{path} is not a spec bundle")
+    magic, indexlength = HEADER.unpack(data[: HEADER.size])
+    if magic != MAGIC:
+        raise SpecBundleException(f"{path} is not a spec bundle")
+    start = HEADER.size + indexlength
+    BUNDLES[path] = {
+        "data": data,
+        "index": jsoncodec.loads(data[HEADER.size : start]),
+        "start": start,
+    }
+    return BUNDLES[path]
+
+
+def read_blob(bundle, offset, length):
+    start = bundle["start"] + offset
+    return jsoncodec.loads(bundle["data"][start : start + length])
+
+
+def get_titles(bundle):
+    return {
+        name: title for (name, (title, _, _)) in bundle["index"]["services"].items()
+    }
+
+
+def load_spec(bundle, name):
+    _, offset, length = bundle["index"]["services"][name]
+    return read_blob(bundle, offset, length)
+
+
+def load_searchindex(bundle):
+    return read_blob(bundle, *bundle["index"]["searchindex"])
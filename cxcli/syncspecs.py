@@ -1,18 +1,30 @@
-import yaml
-import json
 import os
-import requests
 import os.path
 import errno
 import shutil
 from rich.progress import track
+import bisect
 import concurrent.futures
+import re
+import subprocess
+import sys
+import time
 from urllib.parse import urlparse
 
+from . import jsoncodec
+from . import transport
+from . import yamlcodec
+
 URL = "https://developer-data.cloud.com/master"
 APISPECPATH = os.path.join(os.path.expanduser("~"), ".cxcli", "apispecs")
 METACACHEPATH = os.path.join(APISPECPATH, "metadata.dat")
+SEARCHINDEXPATH = os.path.join(APISPECPATH, "searchindex.dat")
+REFRESHLOCKPATH = os.path.join(os.path.expanduser("~"), ".cxcli", "refresh.lock")
 WORKERCOUNT = 4
+# Seconds after which specs get refreshed in the background, 0 disables it
+SPECMAXAGE = int(os.environ.get("CXCLI_SPEC_MAX_AGE", 7 * 24 * 60 * 60))
+# Seconds after which a refresh is assumed to have died
+REFRESHTIMEOUT = 60 * 60
 
 
 def fetch_portal_specs_from_sitedata(sitedata, specsdict={}):
@@ -44,9 +56,9 @@ def fetch_portal_specs_from_sitedata(sitedata, specsdict={}):
 
 
 def fetch_portal_specs():
-    req = requests.get(f"{URL}/all_site_data.json")
+    req = transport.get_session().get(f"{URL}/all_site_data.json")
     req.raise_for_status()
-    data = yaml.safe_load(req.content)
+    data = jsoncodec.loads(req.content)
     specsdict = fetch_portal_specs_from_sitedata(data)
     return specsdict
 
@@ -84,10 +96,13 @@ def make_spec_dir():
             raise
 
 
-def sync_specs(specdict):
-    make_spec_dir()
+def sync_specs(specdict, specpath=None):
+    specpath = specpath or APISPECPATH
+    os.makedirs(specpath, exist_ok=True)
     with concurrent.futures.ThreadPoolExecutor(max_workers=WORKERCOUNT) as executor:
-        results = executor.map(sync_specs_single, specdict.items())
+        results = executor.map(
+            sync_specs_single, specdict.items(), [specpath] * len(specdict)
+        )
         groups = {}
         for result in track(
             results, description="Downloading OpenAPI specs...", total=len(specdict)
@@ -100,12 +115,12 @@ def sync_specs(specdict):
                 groups[groupname] = {}
             groups[groupname] = merge_spec(spec, groups[groupname])
     for groupname, groupspec in groups.items():
-        with open(os.path.join(APISPECPATH, groupname), "w+") as fp:
-            json.dump(groupspec, fp, indent=2)
-    build_metadata()
+        jsoncodec.dump_file(groupspec, os.path.join(specpath, groupname), indent=True)
+    if specpath == APISPECPATH:
+        build_metadata()
 
 
-def sync_specs_single(openapi_spec):
+def sync_specs_single(openapi_spec, specpath=None):
     (apiname, apiurl) = openapi_spec
     if apiname == "workspaceenvironmentmanagement":
         apiname = "wem"
@@ -114,17 +129,17 @@ def sync_specs_single(openapi_spec):
         groupname = f"{asplit[0]}_{asplit[1]}.json"
     else:
         groupname = f"{apiname}.json"
-    if os.path.exists(os.path.join(APISPECPATH, groupname)):
+    if os.path.exists(os.path.join(specpath or APISPECPATH, groupname)):
         # Todo: check age and expire
         return
-    response = requests.get(f"{apiurl}")
+    response = transport.get_session().get(f"{apiurl}")
     if not response.ok:
         print(f"Failed to get {apiname} from {apiurl}")
         return
     if apiurl.endswith(".yaml") or apiurl.endswith(".yml"):
-        spec = yaml.safe_load(response.content)
+        spec = yamlcodec.load(response.content)
     elif apiurl.endswith(".json") or apiurl.endswith("/swagger/docs/v1"):
-        spec = response.json()
+        spec = jsoncodec.loads(response.content)
     else:
         raise Exception(apiurl)
     if apiname == "microapps":
@@ -163,11 +178,218 @@ def patch_parameters(spec, add_parameters):
 
 def build_metadata():
     metacache = {}
+    searchindex = {"operations": [], "terms": {}}
     for filename in sorted(os.listdir(APISPECPATH)):
         if not filename.endswith(".json"):
             continue
-        with open(os.path.join(APISPECPATH, filename), "r") as read_file:
-            spec = json.load(read_file)
-            metacache[filename.replace(".json", "")] = spec["info"]["title"]
-    with open(METACACHEPATH, "w") as fp:
-        json.dump(metacache, fp, indent=2)
+        spec = jsoncodec.load_file(os.path.join(APISPECPATH, filename))
+        metacache[filename.replace(".json", "")] = spec["info"]["title"]
+        index_spec(searchindex, filename.replace(".json", ""), spec)
+    # Sorted, for prefix matching by bisection
+    searchindex["terms"] = dict(sorted(searchindex["terms"].items()))
+    jsoncodec.dump_file(metacache, METACACHEPATH, indent=True)
+    jsoncodec.dump_file(searchindex, SEARCHINDEXPATH)
+
+
+def get_operations(spec):
+    """Yield (path, method, operationid) for every operation the CLI offers
+
+    Shared by the CLI and the search index, so that both skip and name
+    operations the same way.
+    """
+    operationids = set()
+    for path, pathvalue in spec.get("paths", {}).items():
+        for method, methodvalue in pathvalue.items():
+            if method not in ("get", "post", "delete", "patch", "put"):
+                continue
+            # Todo: Try to protect against empty operationIds, like the administrators API
+            operationid = methodvalue.get("operationId")
+            if operationid is None:
+                if "summary" not in methodvalue:
+                    continue
+                operationid = re.sub("[^a-zA-Z ]+", "", methodvalue["summary"])
+            # Skip "ping" operations and operations that indicate that they will only work with ServiceKey
+            if "ping" in operationid.lower() or (
+                "summary" in methodvalue
+                and "[ServiceKey]" in methodvalue["summary"]
+                and "[BearerToken]" not in methodvalue["summary"]
+            ):
+                continue
+            # ToDo: Tweak awkward operationIds, like Microapps', to not contain spaces
+            operationid = operationid.replace(" ", "_")
+            # ToDo: Work around duplicate operationIds, like in agenthub by renaming
+            if operationid in operationids:
+                counter = 2
+                while operationid + str(counter) in operationids:
+                    counter += 1
+                operationid = operationid + str(counter)
+            operationids.add(operationid)
+            yield path, method, operationid
+
+
+# How much a matching term counts, depending on where it was found
+SEARCHWEIGHTS = {"operationid": 4, "service": 3, "title": 2, "path": 2, "summary": 1}
+
+
+def tokenize(text):
+    # Split camelCase, snake_case, paths and sentences into lower-case terms
+    text = re.sub("([a-z0-9])([A-Z])", r"\1 \2", text)
+    return [term for term in re.split("[^a-zA-Z0-9]+", text.lower()) if term]
+
+
+def get_compound_terms(text):
+    # The words as written, e.g. getmachines, for queries that don't split them
+    return [term for term in re.split("[^a-z0-9]+", text.lower()) if term]
+
+
+def index_spec(searchindex, servicename, spec):
+    title = spec["info"]["title"]
+    for path, method, operationid in get_operations(spec):
+        summary = spec["paths"][path][method].get("summary", "")
+        docid = len(searchindex["operations"])
+        searchindex["operations"].append(
+            [servicename, operationid, method.upper(), path, summary]
+        )
+        weights = {}
+        for field, text in (
+            ("operationid", operationid),
+            ("service", servicename),
+            ("title", title),
+            ("path", path),
+            ("summary", summary),
+        ):
+            terms = tokenize(text)
+            if field in ("operationid", "path"):
+                terms += get_compound_terms(text)
+            if field == "operationid":
+                terms.append("".join(get_compound_terms(text)))
+            for term in terms:
+                weights[term] = max(weights.get(term, 0), SEARCHWEIGHTS[field])
+        for term, weight in weights.items():
+            searchindex["terms"].setdefault(term, []).append([docid, weight])
+
+
+def search_operations(terms, limit=20, searchindex=None):
+    """Rank operations by matching terms, using the index from build_metadata"""
+    if searchindex is None:
+        searchindex = jsoncodec.load_file(SEARCHINDEXPATH)
+    # Already sorted by build_metadata, which makes this cheap
+    indexterms = sorted(searchindex["terms"])
+    scores = {}
+    matches = {}
+    for queryterm in tokenize(" ".join(terms)):
+        # Allow prefix matches, but prefer exact ones
+        position = bisect.bisect_left(indexterms, queryterm)
+        while position < len(indexterms) and indexterms[position].startswith(queryterm):
+            term = indexterms[position]
+            position += 1
+            factor = 1.0 if term == queryterm else 0.5
+            for docid, weight in searchindex["terms"][term]:
+                scores[docid] = scores.get(docid, 0) + weight * factor
+                matches.setdefault(docid, set()).add(queryterm)
+    # Operations matching more of the query terms always rank first
+    ranked = sorted(
+        scores, key=lambda docid: (-len(matches[docid]), -scores[docid], docid)
+    )
+    return [searchindex["operations"][docid] for docid in ranked[:limit]]
+
+
+def get_specs_age():
+    try:
+        return time.time() - os.path.getmtime(METACACHEPATH)
+    except FileNotFoundError:
+        return None
+
+
+def is_refresh_lock_stale():
+    try:
+        return time.time() - os.path.getmtime(REFRESHLOCKPATH) > REFRESHTIMEOUT
+    except FileNotFoundError:
+        return False
+
+
+def read_refresh_lock():
+    try:
+        with open(REFRESHLOCKPATH, "r") as fp:
+            return fp.read()
+    except FileNotFoundError:
+        return None
+
+
+def acquire_refresh_lock():
+    """Return the token that identifies this process as the lock's owner, or None"""
+    token = f"{os.getpid()}-{os.urandom(8).hex()}"
+    os.makedirs(os.path.dirname(REFRESHLOCKPATH), exist_ok=True)
+    try:
+        fd = os.open(REFRESHLOCKPATH, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        if not is_refresh_lock_stale():
+            return None
+        # The previous refresh died - take over, unless another process just did
+        with open(REFRESHLOCKPATH + f".{token}", "w") as fp:
+            fp.write(token)
+        os.replace(REFRESHLOCKPATH + f".{token}", REFRESHLOCKPATH)
+        return token if read_refresh_lock() == token else None
+    with os.fdopen(fd, "w") as fp:
+        fp.write(token)
+    return token
+
+
+def release_refresh_lock(token):
+    # Leave the lock alone, if another process took it over meanwhile
+    if read_refresh_lock() == token:
+        os.unlink(REFRESHLOCKPATH)
+
+
+def refresh_specs_if_stale():
+    """Start a detached background refresh when the specs exceed SPECMAXAGE"""
+    age = get_specs_age()
+    if SPECMAXAGE <= 0 or age is None or age < SPECMAXAGE:
+        return False
+    if os.path.exists(REFRESHLOCKPATH) and not is_refresh_lock_stale():
+        # A refresh is already running
+        return False
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = (
+            subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        kwargs["start_new_session"] = True
+    subprocess.Popen(
+        [sys.executable, "-m", "cxcli.syncspecs"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        close_fds=True,
+        **kwargs,
+    )
+    return True
+
+
+def refresh_specs():
+    # Downloads into a staging directory, and then swaps the specs in file by
+    # file with atomic renames. Running processes keep using the specs they read.
+    token = acquire_refresh_lock()
+    if token is None:
+        return
+    stagingpath = APISPECPATH + ".staging"
+    try:
+        # Also delays the next attempt, should this one fail
+        if os.path.exists(METACACHEPATH):
+            os.utime(METACACHEPATH)
+        shutil.rmtree(stagingpath, ignore_errors=True)
+        sync_specs(fetch_portal_specs(), stagingpath)
+        for filename in os.listdir(stagingpath):
+            os.replace(
+                os.path.join(stagingpath, filename),
+                os.path.join(APISPECPATH, filename),
+            )
+        build_metadata()
+    finally:
+        shutil.rmtree(stagingpath, ignore_errors=True)
+        release_refresh_lock(token)
+
+
+if __name__ == "__main__":
+    refresh_specs()
@@ -0,0 +1,275 @@
+import base64
+import importlib.util
+import json
+import logging
+import os
+import ssl
+import threading
+import urllib.parse
+
+import requests
+
+try:
+    import httpx
+except ImportError:
+    # HTTP/2 is optional: pip install httpx[http2]
+    httpx = None
+if httpx is not None and importlib.util.find_spec("h2") is None:
+    # httpx without its http2 extra
+    httpx = None
+
+from . import metrics
+
+log = logging.getLogger()
+
+# Connections kept per host, so that concurrent requests can reuse them
+POOLSIZE = 32
+# Header that tells a local stand-in server, which host a request was meant for
+ORIGINALHOSTHEADER = "X-Cxcli-Original-Host"
+
+# Set by --http2, alternatively set CXCLI_HTTP2=1
+USEHTTP2 = False
+
+SESSION = None
+SESSIONLOCK = threading.Lock()
+RECORDLOCK = threading.Lock()
+
+
+def override_endpoint(request, endpoint):
+    # Send the request to another endpoint, e.g. a local stand-in server
+    url = urllib.parse.urlsplit(request.url)
+    request.headers[ORIGINALHOSTHEADER] = url.netloc
+    request.url = urllib.parse.urlunsplit(
+        (endpoint.scheme, endpoint.netloc) + tuple(url[2:])
+    )
+
+
+class EndpointOverrideAdapter(requests.adapters.HTTPAdapter):
+    """Send all requests to one endpoint, e.g. a local stand-in server"""
+
+    def __init__(self, endpoint, **kwargs):
+        self.endpoint = urllib.parse.urlsplit(endpoint)
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        override_endpoint(request, self.endpoint)
+        return super().send(request, **kwargs)
+
+
+def get_ssl_context(verify, cert):
+    # The TLS settings requests resolved, e.g. from REQUESTS_CA_BUNDLE
+    if isinstance(verify, str):
+        if os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+    else:
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    if cert:
+        if isinstance(cert, str):
+            context.load_cert_chain(cert)
+        else:
+            context.load_cert_chain(*cert)
+    return context
+
+
+class HTTP2Adapter(requests.adapters.BaseAdapter):
+    """Send requests via httpx, which multiplexes concurrent requests to the same
+    host over one HTTP/2 connection. Hosts without HTTP/2 support get HTTP/1.1.
+    Requests via a proxy are sent by requests, over HTTP/1.1."""
+
+    def __init__(self, endpoint=None, client=None):
+        super().__init__()
+        self.endpoint = urllib.parse.urlsplit(endpoint) if endpoint else None
+        # A given client serves all requests, otherwise there's one client per
+        # TLS configuration, as httpx configures TLS per client
+        self.client = client
+        self.clients = {}
+        self.clientslock = threading.Lock()
+        self.proxyadapter = requests.adapters.HTTPAdapter(
+            pool_connections=POOLSIZE, pool_maxsize=POOLSIZE
+        )
+
+    def get_client(self, verify, cert):
+        if self.client is not None:
+            return self.client
+        key = (verify, tuple(cert) if isinstance(cert, (list, tuple)) else cert)
+        with self.clientslock:
+            if key not in self.clients:
+                self.clients[key] = httpx.Client(
+                    http2=True,
+                    verify=True if key == (True, None) else get_ssl_context(*key),
+                    limits=httpx.Limits(
+                        max_connections=POOLSIZE, max_keepalive_connections=POOLSIZE
+                    ),
+                    # requests already resolved the environment's settings
+                    trust_env=False,
+                )
+            return self.clients[key]
+
+    def send(
+        self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None
+    ):
+        if self.endpoint is not None:
+            override_endpoint(request, self.endpoint)
+        if requests.utils.select_proxy(request.url, proxies):
+            return self.proxyadapter.send(
+                request,
+                stream=stream,
+                timeout=timeout,
+                verify=verify,
+                cert=cert,
+                proxies=proxies,
+            )
+        client = self.get_client(verify, cert)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        try:
+            httpxresponse = client.request(
+                request.method,
+                request.url,
+                headers=dict(request.headers),
+                content=request.body,
+                timeout=timeout,
+            )
+        except httpx.TimeoutException as exc:
+            raise requests.exceptions.Timeout(exc, request=request)
+        except httpx.HTTPError as exc:
+            raise requests.exceptions.ConnectionError(exc, request=request)
+        response = requests.Response()
+        response.status_code = httpxresponse.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(
+            {key: httpxresponse.headers[key] for key in httpxresponse.headers.keys()}
+        )
+        # httpx already decoded the content
+        response._content = httpxresponse.content
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.reason = httpxresponse.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        if self.client is not None:
+            self.client.close()
+        for client in self.clients.values():
+            client.close()
+        self.proxyadapter.close()
+
+
+def get_adapter():
+    endpoint = os.environ.get("CXCLI_ENDPOINT")
+    if USEHTTP2 or os.environ.get("CXCLI_HTTP2", "0") not in ("", "0"):
+        if httpx is not None:
+            return HTTP2Adapter(endpoint)
+        log.warning("HTTP/2 requires httpx[http2], falling back to HTTP/1.1")
+    if endpoint:
+        return EndpointOverrideAdapter(
+            endpoint, pool_connections=POOLSIZE, pool_maxsize=POOLSIZE
+        )
+    return requests.adapters.HTTPAdapter(
+        pool_connections=POOLSIZE, pool_maxsize=POOLSIZE
+    )
+
+
+def get_session():
+    # One session per process, so that connections are kept alive across requests
+    global SESSION
+    with SESSIONLOCK:
+        if SESSION is None:
+            session = requests.Session()
+            adapter = get_adapter()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            if os.environ.get("CXCLI_RECORD"):
+                session.hooks["response"].append(record_response)
+            session.hooks["response"].append(metrics.record_response)
+            SESSION = session
+    return SESSION
+
+
+def encode_body(body):
+    if body is None:
+        return None, "text"
+    if isinstance(body, str):
+        return body, "text"
+    try:
+        return body.decode("utf-8"), "text"
+    except UnicodeDecodeError:
+        return base64.b64encode(body).decode("ascii"), "base64"
+
+
+def decode_body(body, encoding):
+    if body is None:
+        return b""
+    if encoding == "base64":
+        return base64.b64decode(body)
+    return body.encode("utf-8")
+
+
+def redact_request_body(body):
+    # Don't write client secrets to cassettes
+    if body and "client_secret=" in body:
+        fields = urllib.parse.parse_qsl(body, keep_blank_values=True)
+        body = urllib.parse.urlencode(
+            [
+                (key, "REDACTED" if key == "client_secret" else value)
+                for (key, value) in fields
+            ]
+        )
+    return body
+
+
+def redact_response_body(body):
+    # Neither access tokens
+    try:
+        content = json.loads(body)
+    except (TypeError, ValueError):
+        return body
+    if isinstance(content, dict) and "access_token" in content:
+        content["access_token"] = "REDACTED"
+        body = json.dumps(content)
+    return body
+
+
+def record_response(response, *args, **kwargs):
+    """Append the request/response pair to the cassette in CXCLI_RECORD"""
+    request = response.request
+    requestbody, requestencoding = encode_body(request.body)
+    if requestencoding == "text":
+        requestbody = redact_request_body(requestbody)
+    responsebody, responseencoding = encode_body(response.content)
+    if responseencoding == "text":
+        responsebody = redact_response_body(responsebody)
+    interaction = {
+        "request": {
+            "method": request.method,
+            "url": request.url,
+            "headers": {
+                key: value
+                for (key, value) in request.headers.items()
+                if key.lower() != "authorization"
+            },
+            "body": requestbody,
+            "encoding": requestencoding,
+        },
+        "response": {
+            "status": response.status_code,
+            "headers": dict(response.headers),
+            "body": responsebody,
+            "encoding": responseencoding,
+            "elapsed": response.elapsed.total_seconds(),
+        },
+    }
+    with RECORDLOCK:
+        with open(os.environ["CXCLI_RECORD"], "a") as fp:
+            fp.write(json.dumps(interaction) + "\n")
+
+
+def read_cassette(path):
+    with open(path, "r") as fp:
+        return [json.loads(line) for line in fp if line.strip()]
@@ -0,0 +1,17 @@
+import yaml
+
+try:
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:
+    # PyYAML was built without libyaml, use the pure Python implementation
+    from yaml import SafeDumper, SafeLoader
+
+
+def load(data):
+    return yaml.load(data, Loader=SafeLoader)
+
+
+def dump(obj, explicit_start=False):
+    return yaml.dump(
+        obj, Dumper=SafeDumper, sort_keys=False, explicit_start=explicit_start
+    )
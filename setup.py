@@ -41,4 +41,10 @@ setuptools.setup(
     },
     python_requires=">=3.6",
     install_requires=required,
+    extras_require={
+        "columnar": ["pyarrow>=3.0.0"],
+        "http2": ["httpx[http2]>=0.18.0"],
+        "fast": ["orjson>=3.5.0"],
+        "zstd": ["zstandard>=0.15.0"],
+    },
 )
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import argparse
+import csv
+import gzip
+import io
+import json
 import os
 import sys
 import pytest
@@ -129,3 +134,574 @@ def test_output_as_rawprint(mocker, services_mock):
 def test_main(mocker, services_mock):
     rc = clidriver.main()
     assert rc == 0
+
+
+def test_resolve_openapi_references():
+    service = {
+        "spec": {
+            "definitions": {
+                "Name": {"type": "string"},
+                "Person": {
+                    "type": "object",
+                    "properties": {
+                        "name": {"$ref": "#/definitions/Name"},
+                        "aliases": {
+                            "type": "array",
+                            "items": {"$ref": "#/definitions/Name"},
+                        },
+                    },
+                },
+                "Node": {
+                    "type": "object",
+                    "properties": {"next": {"$ref": "#/definitions/Node"}},
+                },
+            },
+            "parameters": {
+                "body": {"in": "body", "schema": {"$ref": "#/definitions/Person"}}
+            },
+        }
+    }
+    parameter = clidriver.resolve_openapi_references(
+        service, {"$ref": "#/parameters/body"}
+    )
+    properties = parameter["schema"]["properties"]
+    assert properties["name"] == {"type": "string"}
+    assert properties["aliases"]["items"] is properties["name"]
+    # Resolved definitions are shared between operations
+    again = clidriver.resolve_openapi_references(
+        service, {"in": "body", "schema": {"$ref": "#/definitions/Person"}}
+    )
+    assert again["schema"] is parameter["schema"]
+    # Cycles are detected and left unresolved
+    node = clidriver.resolve_openapi_references(
+        service, {"in": "body", "schema": {"$ref": "#/definitions/Node"}}
+    )
+    assert node["schema"] == {"$ref": "#/definitions/Node"}
+
+
+def test_resolve_openapi_schema_cycles():
+    definitions = {
+        "Folder": {
+            "type": "object",
+            "properties": {
+                "Parent": {"$ref": "#/definitions/Parent"},
+                "Owner": {"$ref": "#/definitions/User"},
+            },
+        },
+        "Parent": {"allOf": [{"$ref": "#/definitions/Folder"}]},
+        "User": {
+            "type": "object",
+            "properties": {"Name": {"type": "string"}},
+            "example": {"$ref": "not a reference"},
+        },
+        "Share": {
+            "type": "array",
+            "items": {"$ref": "#/definitions/Folder"},
+        },
+    }
+    resolver = clidriver.get_reference_resolver({"spec": {"definitions": definitions}})
+    share = clidriver.resolve_openapi_schema(resolver, {"$ref": "#/definitions/Share"})
+    # Definitions on a cycle are left as references, wherever they are reached from
+    assert share["items"] == {"$ref": "#/definitions/Folder"}
+    assert resolver["cyclic"] == {"Folder", "Parent"}
+    folder = clidriver.resolve_openapi_schema(
+        resolver, {"$ref": "#/definitions/Folder"}
+    )
+    assert folder == {"$ref": "#/definitions/Folder"}
+    # Examples aren't schemas, so they stay as they are
+    user = clidriver.resolve_openapi_schema(resolver, {"$ref": "#/definitions/User"})
+    assert user is definitions["User"]
+
+
+def test_response_schema_without_parameters():
+    service = {
+        "name": "machines",
+        "spec": {
+            "host": "api.cloud.com",
+            "paths": {
+                "/Machines": {
+                    "get": {
+                        "operationId": "Machines_GetMachines",
+                        "responses": {
+                            "200": {"schema": {"$ref": "#/definitions/Machines"}}
+                        },
+                    }
+                }
+            },
+            "definitions": {
+                "Machines": {
+                    "type": "object",
+                    "properties": {"Id": {"type": "string"}},
+                }
+            },
+        },
+    }
+    clidriver.patch_spec(service)
+    assert "definitions" not in service["spec"]
+    aspec = service["spec"]["paths"]["/Machines"]["get"]
+    aspec["reference_resolver"] = clidriver.get_reference_resolver(service)
+    assert clidriver.get_response_schema(aspec)["properties"] == {
+        "Id": {"type": "string"}
+    }
+
+
+def test_generate_table_chunks(mocker):
+    mocker.patch.object(clidriver, "TABLESAMPLESIZE", 3)
+    mocker.patch.object(clidriver, "TABLECHUNKSIZE", 2)
+    rows = [{"a": 1}, {"a": 2, "b": "x"}, {"b": "y"}, {"a": 4}, {"c": 5}]
+    tables = list(clidriver.generate_table({"items": rows, "count": 5}))
+    assert len(tables) == 2
+    # Columns are taken from all rows, not just the sampled ones
+    assert [column.header for column in tables[0].columns] == ["a", "b", "c"]
+    assert tables[0].row_count == 3 and not tables[1].show_header
+    # Rows that are still arriving get their columns from the sample
+    warning = mocker.patch.object(clidriver.log, "warning")
+    tables = list(clidriver.generate_table_rows(iter(rows)))
+    assert [column.header for column in tables[0].columns] == ["a", "b"]
+    assert "Leaving out c" in warning.call_args[0][0]
+    tables = list(clidriver.generate_table(["x", "y"], columns=["value"]))
+    assert tables[0].row_count == 2
+
+
+def test_generate_csv_columns():
+    rows = [{"a": 1, "b": 2}, {"b": 3, "c": 4}]
+    assert clidriver.generate_csv(rows, ["b", "c"]).splitlines() == [
+        "b,c",
+        "2,",
+        "3,4",
+    ]
+
+
+def test_generate_csv_flattened():
+    rowschema = {
+        "Id": {"type": "string"},
+        "Message": {"type": "object", "properties": {"en-US": {"type": "string"}}},
+    }
+    rows = [
+        {"Id": "a", "Message": {"en-US": "Hi"}, "Tags": ["x", "y"], "@odata.type": "t"},
+        {"Id": "b", "Disks": [{"Size": 1}], "Enabled": None},
+    ]
+    output = clidriver.generate_csv(rows, rowschema=rowschema)
+    header, first, second = csv.reader(io.StringIO(output))
+    assert header == ["Id", "Message.en-US", "Tags", "@odata.type", "Disks", "Enabled"]
+    assert first == ["a", "Hi", "x, y", "t", "", ""]
+    assert json.loads(second[4]) == [{"Size": 1}] and second[5] == ""
+
+
+def test_warn_about_new_keys(mocker):
+    warning = mocker.patch.object(clidriver.log, "warning")
+    rows = [{"Id": "a", "Message": {"en-US": "Hi"}, "@odata.type": "t"}]
+    columns = ["Id", "Message.en-US", "@odata.type"]
+    assert list(clidriver.warn_about_new_keys(rows, columns)) == rows
+    warning.assert_not_called()
+    list(clidriver.warn_about_new_keys([{"Id": "b", "Tags": []}], columns))
+    assert "Leaving out Tags" in warning.call_args[0][0]
+
+
+def test_print_result_yaml_documents(capsys):
+    args = argparse.Namespace(output_as="yaml")
+    clidriver.print_result([{"a": 1}, {"a": 2}], args)
+    assert capsys.readouterr().out == "---\na: 1\n---\na: 2\n"
+
+
+def test_generate_yaml_chunks_items():
+    result = {"Items": [{"a": 1}, {"a": 2}], "ContinuationToken": "x"}
+    chunks = list(clidriver.generate_yaml_chunks(result))
+    # Rendered item by item, as one document with the other keys
+    assert chunks == ["Items:\n", "- a: 1\n", "- a: 2\n", "ContinuationToken: x\n"]
+
+
+def test_write_output_file_csv_gz(tmp_path):
+    path = str(tmp_path / "records.csv.gz")
+    args = argparse.Namespace(output_as="csv", output_file=path, columns=["a"])
+    result = {"Items": [{"a": 1, "b": 2}, {"a": 3}]}
+    assert clidriver.write_output_file(result, args) == 0
+    assert gzip.open(path, "rt").read().splitlines() == ["a", "1", "3"]
+
+
+def test_get_customers(tmp_path):
+    customersfile = tmp_path / "customers.txt"
+    customersfile.write_text("cust1\n# Partner tenants\ncust2 # EU\n\ncust1\n")
+    assert clidriver.get_customers(str(customersfile)) == ["cust1", "cust2"]
+    assert clidriver.get_customers("cust1, cust2,") == ["cust1", "cust2"]
+
+
+def test_authenticate_api_per_customer(mocker, requests_mock, tmp_path):
+    mocker.patch.object(clidriver, "use_environ_keys", return_value=True)
+    mocker.patch.dict(clidriver.TOKENCACHE, clear=True)
+    mocker.patch.object(clidriver, "TOKENPATH", str(tmp_path))
+    for customerid in ("cust1", "cust2"):
+        requests_mock.post(
+            f"https://api-us.cloud.com/cctrustoauth2/{customerid}/tokens/clients",
+            json={"access_token": f"token-{customerid}"},
+        )
+    config = {"clientid": "id", "clientsecret": "secret", "profile": ""}
+    for _ in range(2):
+        for customerid in ("cust1", "cust2"):
+            headers = clidriver.authenticate_api(dict(config, customerid=customerid))
+            assert headers["Authorization"] == f"CwsAuth bearer=token-{customerid}"
+    assert requests_mock.call_count == 2
+    # Other processes reuse the stored tokens
+    clidriver.TOKENCACHE.clear()
+    headers = clidriver.authenticate_api(dict(config, customerid="cust1"))
+    assert headers["Authorization"] == "CwsAuth bearer=token-cust1"
+    assert requests_mock.call_count == 2
+    tokenpath = clidriver.get_token_path(dict(config, customerid="cust1")) + ".json"
+    assert os.stat(tokenpath).st_mode & 0o777 == 0o600
+    # Malformed entries, e.g. from older versions, get refreshed
+    for stored in ('{"access_token": "old"}', '{"timestamp": "x"}', "[]"):
+        with open(tokenpath, "w") as fp:
+            fp.write(stored)
+        clidriver.TOKENCACHE.clear()
+        headers = clidriver.authenticate_api(dict(config, customerid="cust1"))
+        assert headers["Authorization"] == "CwsAuth bearer=token-cust1"
+    assert requests_mock.call_count == 5
+
+
+def test_diff_results():
+    old = {"Items": [{"Id": "a", "State": "On"}, {"Id": "b", "State": "On"}], "n": 2}
+    new = {"Items": [{"Id": "b", "State": "Off"}, {"Id": "c", "State": "On"}], "n": 2}
+    assert clidriver.diff_results(old, new) == [
+        ("-", "Items[Id=a]", {"Id": "a", "State": "On"}, None),
+        ("~", "Items[Id=b].State", "On", "Off"),
+        ("+", "Items[Id=c]", None, {"Id": "c", "State": "On"}),
+    ]
+    assert clidriver.diff_results([1, 2], [1, 3, 4]) == [
+        ("~", "[1]", 2, 3),
+        ("+", "[2]", None, 4),
+    ]
+
+
+def test_follow_command(mocker, requests_mock, tmp_path):
+    mocker.patch.object(clidriver, "CHECKPOINTPATH", str(tmp_path))
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "get",
+        "url": "https://api-us.cloud.com/systemlog/records",
+        "parameters": [
+            {"name": "startDateTime", "in": "query"},
+            {"name": "continuationToken", "in": "query"},
+        ],
+    }
+    requests_mock.get(
+        "https://api-us.cloud.com/systemlog/records",
+        text=read_datafile("systemlog_GetRecords.response"),
+    )
+    args = argparse.Namespace(
+        command="systemlog", subcommand="GetRecords", follow=0, verbose=False
+    )
+    config = {"customerid": "dvintfd45cca"}
+    write = mocker.patch("sys.stdout.write")
+    assert clidriver.follow_command(aspec, config, args) == 0
+    assert write.call_count == 2
+    # Nothing new on the second run, which continues from the checkpoint
+    assert clidriver.follow_command(aspec, config, args) == 0
+    assert write.call_count == 2
+    assert requests_mock.last_request.qs["startdatetime"] == [
+        "2021-02-24t21:08:30.0267962z"
+    ]
+
+
+def test_follow_checkpoint_timestamps(mocker, requests_mock):
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "get",
+        "url": "https://api-us.cloud.com/systemlog/records",
+        "parameters": [
+            {"name": "startDateTime", "in": "query"},
+            {"name": "continuationToken", "in": "query"},
+        ],
+    }
+    records = [
+        {"RecordId": "a", "UtcTimestamp": "2021-02-24T21:08:30.5Z"},
+        {"RecordId": "b", "UtcTimestamp": "2021-02-24T21:08:30Z"},
+        {"RecordId": "c", "UtcTimestamp": "2021-02-24T21:08:31Z"},
+        {"RecordId": "d"},
+    ]
+    requests_mock.get(aspec["url"], json={"Items": records})
+    args = argparse.Namespace(
+        command="systemlog",
+        subcommand="GetRecords",
+        verbose=False,
+        startDateTime=None,
+        continuationToken=None,
+    )
+    parameters = clidriver.get_follow_parameters(aspec)
+    checkpoint = {
+        "timestamp": "2021-02-24T21:08:30.2Z",
+        "recordids": [],
+        "untimedids": [],
+    }
+    new, untimedids = clidriver.fetch_new_records(
+        aspec, {}, args, parameters, checkpoint
+    )
+    # Ordered by time, not by the timestamps' text
+    assert [record["RecordId"] for record in new] == ["d", "a", "c"]
+    checkpoint = clidriver.get_next_checkpoint(checkpoint, new, untimedids)
+    assert checkpoint == {
+        "timestamp": "2021-02-24T21:08:31Z",
+        "recordids": ["c"],
+        "untimedids": ["d"],
+    }
+    assert clidriver.fetch_new_records(aspec, {}, args, parameters, checkpoint) == (
+        [],
+        ["d"],
+    )
+    # Only the records without a timestamp that are still returned are remembered
+    records = [
+        {"RecordId": "e", "UtcTimestamp": "2021-02-24T21:08:32Z"},
+        {"RecordId": "f"},
+    ]
+    requests_mock.get(aspec["url"], json={"Items": records})
+    new, untimedids = clidriver.fetch_new_records(
+        aspec, {}, args, parameters, checkpoint
+    )
+    checkpoint = clidriver.get_next_checkpoint(checkpoint, new, untimedids)
+    assert [record["RecordId"] for record in new] == ["f", "e"]
+    assert checkpoint["untimedids"] == ["f"]
+
+
+def test_bench_command(mocker, requests_mock, capsys):
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "get",
+        "url": "https://api-us.cloud.com/systemlog/records",
+        "parameters": [],
+    }
+    alloperations = {"systemlog": {"GetRecords": aspec}}
+    requests_mock.get(
+        "https://api-us.cloud.com/systemlog/records",
+        [{"text": "{}"}, {"text": "{}"}, {"text": "{}"}, {"status_code": 429}],
+    )
+    args = argparse.Namespace(command="systemlog", subcommand="GetRecords")
+    benchargs = argparse.Namespace(requests=4, concurrency=2)
+    config = {"customerid": "dvintfd45cca"}
+    assert clidriver.bench_command(alloperations, config, args, benchargs) == 255
+    assert requests_mock.call_count == 4
+    rows = {
+        line.split("│")[1].strip(): line.split("│")[2].strip()
+        for line in capsys.readouterr().out.splitlines()
+        if line.count("│") == 3
+    }
+    assert rows["Throttled (429)"] == "1" and rows["Errors"] == "1"
+    assert rows["Bytes received"] == "6"
+    assert clidriver.get_percentile([1, 2, 3, 4], 50) == 2
+    assert clidriver.get_percentile([1, 2, 3, 4], 99) == 4
+
+
+def test_wait_for_jobs(mocker, requests_mock):
+    mocker.patch.object(clidriver, "WAITINTERVAL", 0.01)
+    requests_mock.post(
+        "https://api-us.cloud.com/cvad/manage/Machines",
+        status_code=202,
+        headers={"Location": "/cvad/manage/Jobs/1"},
+    )
+    requests_mock.get(
+        "https://api-us.cloud.com/cvad/manage/Jobs/1",
+        [{"json": {"Status": "InProgress"}}, {"json": {"Status": "Complete"}}],
+    )
+    requests_mock.get(
+        "https://api-us.cloud.com/cvad/manage/Jobs/2",
+        json={"Status": "Failed"},
+    )
+    request = {
+        "method": "POST",
+        "url": "https://api-us.cloud.com/cvad/manage/Machines",
+        "headers": {"Authorization": "token", "Content-Type": "application/json"},
+    }
+    response = clidriver.transport.get_session().post(request["url"])
+    jobs = {"cust1": clidriver.get_job(request, response)}
+    assert jobs["cust1"] == {
+        "url": "https://api-us.cloud.com/cvad/manage/Jobs/1",
+        "headers": {"Authorization": "token"},
+    }
+    jobs["cust2"] = {
+        "url": "https://api-us.cloud.com/cvad/manage/Jobs/2",
+        "headers": {},
+    }
+    args = argparse.Namespace(
+        command="cvad", subcommand="Machines", wait=5, verbose=False
+    )
+    finished = [
+        (customerid, response.json()["Status"])
+        for (customerid, response) in clidriver.wait_for_jobs(jobs, args)
+    ]
+    # Reported as each job finishes
+    assert finished == [("cust2", "Failed"), ("cust1", "Complete")]
+
+
+def test_fetch_pages(mocker, requests_mock):
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "get",
+        "url": "https://api-us.cloud.com/cvad/manage/Machines",
+        "parameters": [
+            {"name": "$skip", "in": "query"},
+            {"name": "$top", "in": "query"},
+        ],
+    }
+
+    def page(request, context):
+        skip = int(request.qs.get("$skip", ["0"])[0])
+        return {"TotalCount": 25, "Items": list(range(skip, min(skip + 10, 25)))}
+
+    requests_mock.get("https://api-us.cloud.com/cvad/manage/Machines", json=page)
+    args = argparse.Namespace(command="cvad", subcommand="Machines", verbose=False)
+    parameters = clidriver.get_paging_parameters(aspec)
+    assert parameters == {"offset": "$skip", "limit": "$top"}
+    pages = list(clidriver.fetch_pages(aspec, {}, args, parameters))
+    assert [item for page in pages for item in page["Items"]] == list(range(25))
+    assert requests_mock.call_count == 3
+
+
+def test_split_tool_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--profile")
+    parser.add_argument("--search", nargs="+")
+    argv = "--profile p --verbose bench --requests 5 cvad Jobs --requests 2".split()
+    tool, toolargs, argv = clidriver.split_tool_arguments(parser, argv)
+    assert tool == "bench" and toolargs.requests == 5
+    # The operation's own parameters are left alone
+    assert argv == "--profile p --verbose cvad Jobs --requests 2".split()
+    argv = "--profile=p mirror --local --sql x cvad Jobs --index 1".split()
+    tool, toolargs, argv = clidriver.split_tool_arguments(parser, argv)
+    assert tool == "mirror" and toolargs.local and toolargs.index == []
+    assert argv == "--profile=p cvad Jobs --index 1".split()
+    for argv in (["--profile", "bench", "cvad"], ["--search", "bench"], ["cvad"]):
+        assert clidriver.split_tool_arguments(parser, argv) == (None, None, argv)
+
+
+def test_sync_mirror_offset_pages(mocker, requests_mock, tmp_path):
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "get",
+        "url": "https://api-us.cloud.com/cvad/manage/Machines",
+        "parameters": [
+            {"name": "$skip", "in": "query"},
+            {"name": "$top", "in": "query"},
+        ],
+    }
+    machines = [{"Id": str(i)} for i in range(25)]
+
+    def page(request, context):
+        skip = int(request.qs.get("$skip", ["0"])[0])
+        return {"TotalCount": len(machines), "Items": machines[skip : skip + 10]}
+
+    requests_mock.get("https://api-us.cloud.com/cvad/manage/Machines", json=page)
+    mocker.patch.object(clidriver.console, "print")
+    args = argparse.Namespace(command="cvad", subcommand="Machines", verbose=False)
+    mirrorargs = argparse.Namespace(index=[])
+    db = clidriver.mirror.connect(str(tmp_path / "cust.db"))
+    assert clidriver.sync_mirror(aspec, {}, args, mirrorargs, db, "Machines") == 0
+    assert len(clidriver.mirror.read_records(db, "Machines")) == 25
+    # Records only get removed once all pages have been fetched
+    del machines[3]
+    requests_mock.get(
+        "https://api-us.cloud.com/cvad/manage/Machines",
+        json={"Items": machines[:10]},
+    )
+    assert clidriver.sync_mirror(aspec, {}, args, mirrorargs, db, "Machines") == 0
+    assert len(clidriver.mirror.read_records(db, "Machines")) == 25
+    requests_mock.get("https://api-us.cloud.com/cvad/manage/Machines", json=page)
+    assert clidriver.sync_mirror(aspec, {}, args, mirrorargs, db, "Machines") == 0
+    assert len(clidriver.mirror.read_records(db, "Machines")) == 24
+
+
+def test_build_request(mocker):
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "post",
+        "url": "https://api-us.cloud.com/cvad/{site-id}/Machines/{machineId}?async=true",
+        "parameters": [
+            {"name": "site-id", "in": "path"},
+            {"name": "machineId", "in": "path"},
+            {"name": "Citrix-CustomerId", "in": "header"},
+            {
+                "name": "body",
+                "in": "body",
+                "schema": {
+                    "properties": {
+                        "Tags": {"type": "array"},
+                        "Owner": {
+                            "type": "object",
+                            "properties": {"Name": {"type": "string"}},
+                        },
+                    }
+                },
+            },
+        ],
+    }
+    args = argparse.Namespace(
+        site_id="a b/c",
+        machineId=None,
+        Citrix_CustomerId="customer",
+        Tags=['{"Name": "tag"}'],
+        Owner_Name="owner",
+    )
+    request = clidriver.build_request(aspec, {"region": "eu"}, args)
+    assert (
+        request["url"]
+        == "https://api-eu.cloud.com/cvad/a+b%2Fc/Machines/{machineId}?async=true"
+    )
+    assert request["headers"]["Citrix-CustomerId"] == "customer"
+    assert request["json"] == {"Tags": [{"Name": "tag"}], "Owner": {"Name": "owner"}}
+    # The builder is compiled once and kept with the operation
+    assert "request_builder" in aspec
+
+
+def test_execute_command_for_customers(mocker, requests_mock, capsys):
+    mocker.patch.object(clidriver, "authenticate_api", return_value={})
+    aspec = {
+        "method": "get",
+        "url": "https://api-us.cloud.com/systemlog/records",
+        "parameters": [{"name": "Citrix-CustomerId", "in": "header"}],
+    }
+    requests_mock.get(
+        "https://api-us.cloud.com/systemlog/records",
+        json=lambda request, context: {
+            "Items": [{"RecordId": request.headers["Citrix-CustomerId"]}]
+        },
+    )
+    args = argparse.Namespace(
+        command="systemlog",
+        subcommand="GetRecords",
+        verbose=False,
+        customers=["c1", "c2"],
+        max_concurrency=2,
+        output_as="csv",
+        columns=None,
+        Citrix_CustomerId=None,
+    )
+    rc = clidriver.execute_command_for_customers(aspec, {}, args, None)
+    assert rc == 0
+    lines = capsys.readouterr().out.split()
+    assert lines == ["CustomerId,RecordId", "c1,c1", "c2,c2"]
+
+
+def test_all_pages_command_streams(mocker):
+    events = []
+
+    def fetch_pages(aspec, config, args, parameters):
+        for start in range(0, 30, 10):
+            events.append(f"page {start}")
+            yield {
+                "TotalCount": 30,
+                "Items": [{"Id": i} for i in range(start, start + 10)],
+            }
+
+    mocker.patch.object(clidriver, "fetch_pages", fetch_pages)
+    mocker.patch.object(clidriver, "TABLECHUNKSIZE", 10)
+    mocker.patch.object(clidriver, "TABLESAMPLESIZE", 10)
+    printed = []
+    mocker.patch.object(
+        clidriver.console,
+        "print",
+        lambda chunk, end="\n": events.append("print") or printed.append(chunk),
+    )
+    aspec = {"parameters": [], "responses": {}, "reference_resolver": None}
+    args = argparse.Namespace(output_as="csv", columns=None)
+    assert clidriver.all_pages_command(aspec, {}, args, None) == 0
+    # Output starts before the last page arrived
+    assert events.index("print") < events.index("page 20")
+    assert "".join(printed).split() == ["Id"] + [str(i) for i in range(30)]
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.columnar as columnar
+
+pyarrow = pytest.importorskip("pyarrow")
+import pyarrow.feather
+import pyarrow.parquet
+
+
+def test_get_row_schema():
+    rowschema = {"Id": {"type": "string"}}
+    schema = {
+        "type": "object",
+        "properties": {
+            "Items": {"type": "array", "items": {"properties": rowschema}},
+            "ContinuationToken": {"type": "string"},
+        },
+    }
+    assert columnar.get_row_schema(schema) == rowschema
+    assert columnar.get_row_schema({"type": "string"}) is None
+
+
+@pytest.mark.parametrize("extension", ["parquet", "arrow", "feather"])
+def test_write_columnar(mocker, tmp_path, extension):
+    mocker.patch.object(columnar, "BATCHSIZE", 2)
+    rowschema = {"Count": {"type": "integer"}, "Enabled": {"type": "boolean"}}
+    rows = [
+        {"Count": 1, "Enabled": True, "Tags": ["a"]},
+        {"Count": "2", "Ratio": 0.5},
+        {"Enabled": "false", "Ratio": 1},
+    ]
+    path = str(tmp_path / f"result.{extension}")
+    columnar.write_columnar(path, rows, rowschema)
+    if extension == "parquet":
+        table = pyarrow.parquet.read_table(path)
+        assert pyarrow.parquet.ParquetFile(path).num_row_groups == 2
+    else:
+        table = pyarrow.feather.read_table(path)
+    assert table.schema.names == ["Count", "Enabled", "Tags", "Ratio"]
+    assert table.column("Count").to_pylist() == [1, 2, None]
+    assert table.column("Enabled").to_pylist() == [True, None, False]
+    assert table.column("Tags").to_pylist() == ['["a"]', None, None]
+    assert table.column("Ratio").type == pyarrow.float64()
+
+
+def test_write_columnar_keeps_all_values(mocker, tmp_path):
+    mocker.patch.object(columnar, "BATCHSIZE", 2)
+    rowschema = {"Count": {"type": "integer"}, "Enabled": {"type": "boolean"}}
+    rows = [
+        {"Count": 1, "Enabled": True},
+        {"Count": 2, "Enabled": "maybe"},
+        {"Count": 1.5, "Late": "x"},
+    ]
+    path = str(tmp_path / "result.parquet")
+    columnar.write_columnar(path, rows, rowschema)
+    table = pyarrow.parquet.read_table(path)
+    # Columns that first appear after the first batch are kept
+    assert table.column("Late").to_pylist() == [None, None, "x"]
+    # Columns get widened, instead of truncating values
+    assert table.column("Count").to_pylist() == [1.0, 2.0, 1.5]
+    assert table.column("Enabled").to_pylist() == ["true", "maybe", None]
@@ -0,0 +1,24 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.jsoncodec as jsoncodec
+
+
+@pytest.mark.parametrize("native", [True, False])
+def test_roundtrip(mocker, tmp_path, native):
+    if not native:
+        mocker.patch.object(jsoncodec, "orjson", None)
+    obj = {"title": "Rôles", "responses": {200: {"n": 2**70}}, "items": [1.5, None]}
+    text = jsoncodec.dumps(obj, indent=True)
+    assert text.startswith('{\n  "title": "Rôles"')
+    assert jsoncodec.loads(text.encode("utf-8")) == json.loads(json.dumps(obj))
+    jsoncodec.dump_file(obj, str(tmp_path / "spec.json"))
+    assert jsoncodec.load_file(str(tmp_path / "spec.json"))["title"] == "Rôles"
+    with pytest.raises(json.JSONDecodeError):
+        jsoncodec.loads(b"<html>")
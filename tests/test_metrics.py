@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.jsoncodec as jsoncodec
+import cxcli.metrics as metrics
+import cxcli.transport as transport
+
+
+@pytest.fixture
+def session(mocker, requests_mock):
+    mocker.patch.object(transport, "SESSION", None)
+    mocker.patch.dict(metrics.COUNTERS, clear=True)
+    mocker.patch.dict(metrics.HISTOGRAMS, clear=True)
+    mocker.patch.object(metrics, "SPANS", [])
+    requests_mock.get("https://api-us.cloud.com/systemlog/records", text="{}")
+    return transport.get_session()
+
+
+def test_export_prometheus(mocker, tmp_path, session):
+    path = str(tmp_path / "cxcli.prom")
+    mocker.patch.object(metrics, "PATH", path)
+    for _ in range(2):
+        with metrics.operation("systemlog GetRecords"):
+            session.get("https://api-us.cloud.com/systemlog/records")
+        metrics.count("cxcli_token_refreshes_total")
+        metrics.export()
+        metrics.COUNTERS.clear()
+        metrics.HISTOGRAMS.clear()
+    # Counters accumulate across invocations
+    lines = open(path).read().splitlines()
+    labels = 'operation="systemlog GetRecords"'
+    assert f'cxcli_requests_total{{{labels},method="GET",status="200"}} 2' in lines
+    assert f'cxcli_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in lines
+    assert f"cxcli_response_bytes_total{{{labels}}} 4" in lines
+    assert "cxcli_token_refreshes_total 2" in lines
+
+
+def test_export_spans(mocker, tmp_path, session):
+    path = str(tmp_path / "spans.jsonl")
+    mocker.patch.object(metrics, "PATH", path)
+    session.get("https://api-us.cloud.com/systemlog/records?limit=2")
+    metrics.export()
+    exported = jsoncodec.loads(open(path, "rb").read())
+    span = exported["resourceSpans"][0]["scopeSpans"][0]["spans"][0]
+    assert span["name"] == "other"
+    assert {"key": "http.status_code", "value": {"intValue": "200"}} in span[
+        "attributes"
+    ]
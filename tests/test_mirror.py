@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.mirror as mirror
+
+
+def test_sync_records(tmp_path):
+    db = mirror.connect(str(tmp_path / "cust.db"))
+    machines = [
+        ("a", {"Id": "a", "State": "On", "Tags": ["x"]}),
+        ("b", {"Id": "b", "State": "Off"}),
+    ]
+    assert mirror.sync_records(db, "Machines", ["State"], machines, True) == 2
+    assert mirror.query(db, "SELECT _key FROM Machines WHERE State = 'On'") == [
+        {"_key": "a"}
+    ]
+    # Incremental syncs keep the other records
+    mirror.sync_records(db, "Machines", [], [("c", {"Id": "c"})], False)
+    assert [record["Id"] for record in mirror.read_records(db, "Machines")] == [
+        "a",
+        "b",
+        "c",
+    ]
+    # Complete syncs remove records that are gone, and indexes can be added later
+    mirror.sync_records(db, "Machines", ["Tags"], machines[:1], True)
+    assert mirror.query(db, "SELECT State, Tags FROM Machines") == [
+        {"State": "On", "Tags": '["x"]'}
+    ]
+    mirror.write_checkpoint(db, "Machines", {"timestamp": "t", "recordids": []})
+    assert mirror.read_checkpoint(db, "Machines")["timestamp"] == "t"
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.mockserver as mockserver
+import cxcli.transport as transport
+
+
+@pytest.fixture
+def cassette(mocker, requests_mock, tmp_path):
+    # Record a cassette through the shared session
+    path = str(tmp_path / "cassette.jsonl")
+    mocker.patch.dict(os.environ, {"CXCLI_RECORD": path})
+    mocker.patch.object(transport, "SESSION", None)
+    requests_mock.post(
+        "https://api-us.cloud.com/cctrustoauth2/cust/tokens/clients",
+        json={"access_token": "secret-token"},
+    )
+    requests_mock.get(
+        "https://api-us.cloud.com/systemlog/records",
+        json={"Items": [{"RecordId": "1"}, {"RecordId": "2"}]},
+    )
+    session = transport.get_session()
+    session.post(
+        "https://api-us.cloud.com/cctrustoauth2/cust/tokens/clients",
+        data={"client_id": "id", "client_secret": "secret"},
+    )
+    session.get("https://api-us.cloud.com/systemlog/records", params={"limit": 2})
+    requests_mock.stop()
+    return path
+
+
+def test_record(cassette):
+    interactions = transport.read_cassette(cassette)
+    assert len(interactions) == 2
+    assert "client_secret=REDACTED" in interactions[0]["request"]["body"]
+    assert "secret-token" not in json.dumps(interactions)
+
+
+def test_replay(mocker, cassette):
+    server = mockserver.MockServer(
+        transport.read_cassette(cassette), payloaditems=5, throttlerate=0.5, seed=1
+    )
+    httpd = server.create_server(port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{httpd.server_address[1]}"
+    mocker.patch.dict(os.environ, {"CXCLI_ENDPOINT": endpoint, "CXCLI_RECORD": ""})
+    mocker.patch.object(transport, "SESSION", None)
+    try:
+        session = transport.get_session()
+        statuses = []
+        for _ in range(6):
+            response = session.get(
+                "https://api-us.cloud.com/systemlog/records", params={"limit": 2}
+            )
+            statuses.append(response.status_code)
+            if response.ok:
+                assert len(response.json()["Items"]) == 5
+        assert set(statuses) == {200, 429}
+        response = session.get("https://api-eu.cloud.com/systemlog/records")
+        assert response.status_code == 404
+    finally:
+        httpd.shutdown()
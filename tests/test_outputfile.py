@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+
+import gzip
+import lzma
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.outputfile as outputfile
+
+
+@pytest.mark.parametrize(
+    "filename,read",
+    [
+        ("records.json", lambda path: open(path, "rb").read()),
+        ("records.json.gz", lambda path: gzip.open(path).read()),
+        ("records.json.xz", lambda path: lzma.open(path).read()),
+    ],
+)
+def test_write_chunks(tmp_path, filename, read):
+    path = str(tmp_path / filename)
+    outputfile.write_chunks(path, (b"chunk%d\n" % i for i in range(1000)))
+    assert read(path) == b"".join(b"chunk%d\n" % i for i in range(1000))
+    assert os.listdir(tmp_path) == [filename]
+
+
+def test_write_chunks_failure(tmp_path):
+    def chunks():
+        yield b"partial"
+        raise ValueError("formatting failed")
+
+    with pytest.raises(ValueError):
+        outputfile.write_chunks(str(tmp_path / "records.csv.gz"), chunks())
+    # No partial files are left behind
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.mockserver as mockserver
+import cxcli.regions as regions
+
+
+def start_server(latency):
+    httpd = mockserver.MockServer([], latency=latency).create_server(port=0)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+def test_select_region(mocker, tmp_path):
+    near, far = start_server(0), start_server(0.2)
+    mocker.patch.object(
+        regions,
+        "REGIONS",
+        {
+            "far": {"api": f"127.0.0.1:{far.server_address[1]}"},
+            "near": {"api": f"127.0.0.1:{near.server_address[1]}"},
+            "down": {"api": "127.0.0.1:1"},
+        },
+    )
+    mocker.patch.object(regions, "SCHEME", "http")
+    mocker.patch.object(regions, "SELECTED", {})
+    mocker.patch.object(regions, "REGIONCACHEPATH", str(tmp_path / "regions.json"))
+    try:
+        config = {"profile": "eu", "region": "auto"}
+        assert regions.get_region(config) == "near"
+        assert json.loads((tmp_path / "regions.json").read_text()) == {"eu": "near"}
+        # Later invocations use the cached region
+        mocker.patch.object(regions, "SELECTED", {})
+        probe = mocker.patch.object(regions, "probe_regions")
+        assert regions.get_region(config) == "near"
+        probe.assert_not_called()
+    finally:
+        near.shutdown()
+        far.shutdown()
+
+
+def test_rewrite_host():
+    config = {"profile": "", "region": "eu"}
+    assert regions.rewrite_host("api.cloud.com", config) == "api-eu.cloud.com"
+    assert regions.rewrite_host("api-us.cloud.com", config) == "api-eu.cloud.com"
+    assert (
+        regions.rewrite_host("registry.citrixworkspacesapi.net", config)
+        == "registry.citrixworkspacesapi.net"
+    )
+    assert regions.get_api_host({"profile": "", "region": None}) == "api-us.cloud.com"
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import concurrent.futures
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.metrics as metrics
+import cxcli.singleflight as singleflight
+
+
+def test_do_coalesces(mocker):
+    mocker.patch.object(metrics, "PATH", "metrics.prom")
+    mocker.patch.dict(metrics.COUNTERS, clear=True)
+    calls = []
+    release = threading.Event()
+
+    def function():
+        calls.append(1)
+        release.wait()
+        return {"Items": []}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(singleflight.do, "key", function) for _ in range(4)]
+        while sum(metrics.COUNTERS.values()) < 3:
+            pass
+        release.set()
+        results = [future.result() for future in futures]
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert metrics.COUNTERS == {
+        ("cxcli_coalesced_calls_total", (("operation", "other"),)): 3
+    }
+    # Once done, the next call is made again
+    singleflight.do("key", function)
+    assert len(calls) == 2
+
+
+def test_do_raises():
+    def function():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        singleflight.do("key", function)
+    assert singleflight.CALLS == {}
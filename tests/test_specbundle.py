@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.clidriver as clidriver
+import cxcli.specbundle as specbundle
+import cxcli.syncspecs as syncspecs
+
+
+def test_export_bundle(mocker, tmp_path):
+    spec = {
+        "info": {"title": "Systemlog"},
+        "host": "api-us.cloud.com",
+        "basePath": "/systemlog",
+        "paths": {"/records": {"get": {"operationId": "GetRecords"}}},
+    }
+    apispecpath = tmp_path / "apispecs"
+    apispecpath.mkdir()
+    (apispecpath / "systemlog.json").write_text(json.dumps(spec))
+    (apispecpath / "cvad.json").write_text(json.dumps({"info": {"title": "CVAD"}}))
+    mocker.patch.object(syncspecs, "APISPECPATH", str(apispecpath))
+    mocker.patch.object(syncspecs, "METACACHEPATH", str(apispecpath / "metadata.dat"))
+    mocker.patch.object(syncspecs, "SEARCHINDEXPATH", str(apispecpath / "index.dat"))
+    mocker.patch.object(specbundle, "BUNDLES", {})
+    assert specbundle.export_bundle(str(tmp_path / "specs.bundle")) == 2
+    # Bundles are relocatable
+    os.replace(tmp_path / "specs.bundle", tmp_path / "moved.bundle")
+    mocker.patch.dict(os.environ, {"CXCLI_SPEC_PATH": str(tmp_path / "moved.bundle")})
+    mocker.patch.object(sys, "argv", ["cx", "systemlog", "GetRecords"])
+    services = clidriver.get_all_services()
+    assert services["cvad"]["spec"] == {"info": {"title": "CVAD"}, "paths": {}}
+    assert services["systemlog"]["url"] == "api-us.cloud.com/systemlog"
+    bundle = specbundle.open_bundle(str(tmp_path / "moved.bundle"))
+    matches = syncspecs.search_operations(
+        ["records"], searchindex=specbundle.load_searchindex(bundle)
+    )
+    assert [match[1] for match in matches] == ["GetRecords"]
+
+
+def test_open_bundle_invalid(tmp_path):
+    (tmp_path / "specs.bundle").write_bytes(b"")
+    with pytest.raises(specbundle.SpecBundleException):
+        specbundle.open_bundle(str(tmp_path / "specs.bundle"))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import json
 import os
 import sys
 
@@ -17,3 +18,108 @@ def test_reset_synced_specs(mocker):
 def test_sync_public_specs(mocker, services_mock):
 
     syncspecs.sync_public_specs()
+
+
+def test_search_operations(mocker, tmp_path):
+    spec = {
+        "info": {"title": "Machine Catalogs"},
+        "paths": {
+            "/catalogs/{id}/machines": {
+                "get": {"operationId": "MachineCatalogs_GetMachines"},
+                "parameters": [],
+            },
+            "/catalogs": {"post": {"summary": "Create a machine catalog"}},
+        },
+    }
+    mocker.patch.object(syncspecs, "APISPECPATH", str(tmp_path))
+    mocker.patch.object(syncspecs, "METACACHEPATH", str(tmp_path / "metadata.dat"))
+    mocker.patch.object(syncspecs, "SEARCHINDEXPATH", str(tmp_path / "index.dat"))
+    (tmp_path / "cvadrestapis.json").write_text(json.dumps(spec))
+    syncspecs.build_metadata()
+    matches = syncspecs.search_operations(["catalog", "machines"])
+    assert [match[1] for match in matches] == [
+        "MachineCatalogs_GetMachines",
+        "Create_a_machine_catalog",
+    ]
+    # Words that aren't split, e.g. as the operationId is written
+    for query in ("getmachines", "machinecatalogs", "MachineCatalogs_GetMachines"):
+        matches = syncspecs.search_operations([query])
+        assert matches[0][1] == "MachineCatalogs_GetMachines"
+
+
+def test_index_spec_matches_cli():
+    spec = {
+        "info": {"title": "System"},
+        "paths": {
+            "/ping": {"get": {"operationId": "Ping"}},
+            "/keys": {"get": {"summary": "Get keys [ServiceKey]"}},
+            "/things": {"get": {"operationId": "GetThing"}},
+            "/things/{id}": {"get": {"operationId": "GetThing"}},
+        },
+    }
+    searchindex = {"operations": [], "terms": {}}
+    syncspecs.index_spec(searchindex, "sys", spec)
+    assert [operation[1] for operation in searchindex["operations"]] == [
+        "GetThing",
+        "GetThing2",
+    ]
+    assert syncspecs.search_operations(["ping"], searchindex=searchindex) == []
+    # Prefixes of whole operationIds match as well
+    matches = syncspecs.search_operations(["getth"], searchindex=searchindex)
+    assert [match[1] for match in matches] == ["GetThing", "GetThing2"]
+
+
+def test_refresh_specs(mocker, tmp_path):
+    apispecpath = tmp_path / "apispecs"
+    apispecpath.mkdir()
+    (apispecpath / "cvad.json").write_text(json.dumps({"info": {}, "paths": {}}))
+    mocker.patch.object(syncspecs, "APISPECPATH", str(apispecpath))
+    mocker.patch.object(syncspecs, "METACACHEPATH", str(tmp_path / "metadata.dat"))
+    mocker.patch.object(syncspecs, "SEARCHINDEXPATH", str(tmp_path / "index.dat"))
+    mocker.patch.object(syncspecs, "REFRESHLOCKPATH", str(tmp_path / "refresh.lock"))
+    mocker.patch.object(syncspecs, "fetch_portal_specs", return_value={})
+
+    def sync_specs(specdict, specpath):
+        # Running processes keep reading the current specs meanwhile
+        assert specpath != str(apispecpath)
+        os.makedirs(specpath)
+        spec = {"info": {"title": "CVAD"}, "paths": {}}
+        (tmp_path / "apispecs.staging" / "cvad.json").write_text(json.dumps(spec))
+
+    mocker.patch.object(syncspecs, "sync_specs", side_effect=sync_specs)
+    syncspecs.refresh_specs()
+    assert json.loads((tmp_path / "metadata.dat").read_text()) == {"cvad": "CVAD"}
+    assert not os.path.exists(tmp_path / "apispecs.staging")
+    assert not os.path.exists(tmp_path / "refresh.lock")
+
+
+def test_refresh_specs_if_stale(mocker, tmp_path):
+    mocker.patch.object(syncspecs, "METACACHEPATH", str(tmp_path / "metadata.dat"))
+    mocker.patch.object(syncspecs, "REFRESHLOCKPATH", str(tmp_path / "refresh.lock"))
+    popen = mocker.patch("subprocess.Popen")
+    (tmp_path / "metadata.dat").write_text("{}")
+    assert not syncspecs.refresh_specs_if_stale()
+    os.utime(tmp_path / "metadata.dat", (0, 0))
+    assert syncspecs.refresh_specs_if_stale()
+    assert popen.call_args[0][0][1:] == ["-m", "cxcli.syncspecs"]
+    (tmp_path / "refresh.lock").write_text("")
+    assert not syncspecs.refresh_specs_if_stale()
+    # A lock left behind by a refresh that died doesn't block refreshes
+    os.utime(tmp_path / "refresh.lock", (0, 0))
+    assert syncspecs.refresh_specs_if_stale()
+
+
+def test_refresh_lock(mocker, tmp_path):
+    mocker.patch.object(syncspecs, "REFRESHLOCKPATH", str(tmp_path / "refresh.lock"))
+    token = syncspecs.acquire_refresh_lock()
+    assert token is not None
+    assert syncspecs.acquire_refresh_lock() is None
+    # Another process takes over the stale lock
+    os.utime(tmp_path / "refresh.lock", (0, 0))
+    othertoken = syncspecs.acquire_refresh_lock()
+    assert othertoken not in (None, token)
+    # The previous owner doesn't release the lock it no longer holds
+    syncspecs.release_refresh_lock(token)
+    assert os.path.exists(tmp_path / "refresh.lock")
+    syncspecs.release_refresh_lock(othertoken)
+    assert not os.path.exists(tmp_path / "refresh.lock")
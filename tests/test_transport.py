@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+
+import os
+import ssl
+import sys
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(__file__) + "/../")
+import cxcli.transport as transport
+
+
+def test_get_adapter(mocker):
+    mocker.patch.dict(os.environ, {"CXCLI_HTTP2": "0", "CXCLI_ENDPOINT": ""})
+    assert type(transport.get_adapter()) is requests.adapters.HTTPAdapter
+    mocker.patch.object(transport, "USEHTTP2", True)
+    mocker.patch.object(transport, "httpx", None)
+    # Falls back to HTTP/1.1 when httpx isn't available
+    assert type(transport.get_adapter()) is requests.adapters.HTTPAdapter
+
+
+def test_http2_adapter():
+    httpx = pytest.importorskip("httpx")
+
+    def handler(request):
+        assert request.headers["Authorization"] == "CwsAuth bearer=token"
+        assert request.url.params["limit"] == "2"
+        return httpx.Response(200, json={"Items": []}, headers={"ETag": "abc"})
+
+    session = requests.Session()
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    session.mount("https://", transport.HTTP2Adapter(client=client))
+    response = session.get(
+        "https://api-us.cloud.com/systemlog/records",
+        params={"limit": 2},
+        headers={"Authorization": "CwsAuth bearer=token"},
+    )
+    assert response.ok
+    assert response.json() == {"Items": []}
+    assert response.headers["etag"] == "abc"
+
+
+def test_http2_adapter_settings(mocker):
+    pytest.importorskip("httpx")
+    adapter = transport.HTTP2Adapter()
+    client = mocker.patch.object(transport.httpx, "Client")
+    adapter.get_client(False, None)
+    assert client.call_args.kwargs["verify"].verify_mode == ssl.CERT_NONE
+    # Requests via a proxy go through requests' own adapter
+    send = mocker.patch.object(adapter.proxyadapter, "send", return_value="proxied")
+    request = requests.Request("GET", "https://api-us.cloud.com/").prepare()
+    response = adapter.send(request, proxies={"https": "http://proxy:3128"})
+    assert response == "proxied"
+    assert send.call_args.kwargs["proxies"] == {"https": "http://proxy:3128"}